@@ -1,27 +1,121 @@
-import base64
 import logging
 import os
 import shutil
+import threading
+import time
 
-from flask import Flask, Response, jsonify, request, stream_with_context
+from flask import (
+    Flask,
+    Response,
+    abort,
+    jsonify,
+    request,
+    send_from_directory,
+    stream_with_context,
+)
+from waitress import create_server, wasyncore
 
 import config
+import events
+from archive import SessionArchive, forget_crcs
+import metrics
 import utils
 from data import data, photos_taken, states
+from manifest import forget_manifests, get_manifest
 from modules.camera import CameraThread
+from modules.sensors import HISTORY_SIZE, SensorPoller
+
+PHOTO_FORMATS = (".jpg", ".jpeg", ".png", ".webp", ".tif", ".tiff")
+PHOTO_MAX_AGE = 24 * 60 * 60
+HISTORY_POINTS = 300
+# Stored readings are sent in pages of at most this many
+READINGS_PAGE = 1000
+MAX_READINGS_PAGE = 10000
+
+# Waitress serves every request on a worker thread from a fixed pool
+SERVER_THREADS = 16
+CONNECTION_LIMIT = 64
+# Idle keep-alive connections are closed after this many seconds
+KEEPALIVE_TIMEOUT = 30
+# Bytes buffered per connection before the response blocks, so a slow viewer drops
+# frames instead of queueing them
+OUTBUF_HIGH_WATERMARK = 256 * 1024
+# Streams hold a worker for their whole life, some are kept for the short requests
+MAX_STREAMS = SERVER_THREADS - 4
+STREAM_RETRY = 5
+SHUTDOWN_TIMEOUT = 5
+
+stream_slots = threading.BoundedSemaphore(MAX_STREAMS)
+
+
+class StreamBody:
+    """Response body that gives its streaming slot back once the server closes it"""
+
+    def __init__(self, body):
+        self.body = body
+        self.released = False
+
+    def __iter__(self):
+        return iter(self.body)
+
+    def close(self):
+        try:
+            if hasattr(self.body, "close"):
+                self.body.close()
+        finally:
+            if not self.released:
+                self.released = True
+                stream_slots.release()
+
+
+def stream_response(body, **kwargs) -> Response:
+    """Wrap a generator in a streaming response, or answer 503 when every streaming slot
+    is taken so long-lived responses can't starve the short requests of workers
+    Args:
+        body: The generator of the response body
+        kwargs: Passed on to the response
+    """
+    if not stream_slots.acquire(blocking=False):
+        return Response(
+            "Too many open streams",
+            status=503,
+            headers={"Retry-After": str(STREAM_RETRY)},
+        )
+    return Response(StreamBody(stream_with_context(body)), **kwargs)
 
 
 def create(name: str) -> Flask:
     app = Flask(name)
+    started = time.time_ns()
     logging.getLogger("werkzeug").setLevel(logging.WARNING)
 
     @app.route("/dashboard")
     def get_dashboard():
-        """Serve the current dashboard data.
+        """Serve the current dashboard data. Answers 304 without a body when the client
+        already has this version, either as ?since=<version> or through If-None-Match.
         Returns:
             dict: The current dashboard data.
         """
-        return jsonify(data.get_data())
+        snapshot = data.snapshot()
+        # Versions restart with the process, tell them apart in the cached ETags
+        etag = f"{started}-{snapshot.version}"
+        headers = {"ETag": f'"{etag}"', "X-Data-Version": str(snapshot.version)}
+        since = request.args.get("since", type=int)
+        if since == snapshot.version or etag in request.if_none_match:
+            return Response(status=304, headers=headers)
+        return Response(snapshot.json(), mimetype="application/json", headers=headers)
+
+    @app.route("/events")
+    def get_events():
+        """Server-Sent Events stream. Starts with the whole dashboard, then sends the
+        changed keys as "dashboard" events along with "session_started", "photo_saved"
+        and "transfer_completed".
+        """
+        return stream_response(
+            events.bus.stream(lambda: dict(data.get_data())),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
 
     @app.route("/dashboard/<string:key>", methods=["PUT"])
     def put_dashboard_value(key: str):
@@ -40,9 +134,96 @@ def create(name: str) -> Flask:
             return jsonify({key: data.get(key)})
         return jsonify({"error": f" Key '{key}' not found"}), 404
 
+    @app.route("/sensors/history")
+    def get_sensor_history():
+        """Readings kept by every sensor, averaged down on the server
+        Args (query):
+            sensor: Only return these sensors, can be repeated
+            start: Unix time of the oldest reading
+            end: Unix time of the newest reading
+            points: Maximum readings per sensor
+        Returns:
+            dict: The timestamps and values of every field of each sensor
+        """
+        names = request.args.getlist("sensor") or list(SensorPoller.pollers)
+        unknown = [name for name in names if name not in SensorPoller.pollers]
+        if unknown:
+            return jsonify({"error": f"Unknown sensors {unknown}"}), 404
+
+        start = request.args.get("start", type=float)
+        end = request.args.get("end", type=float)
+        points = request.args.get("points", HISTORY_POINTS, type=int)
+        points = max(1, min(points, HISTORY_SIZE))
+        return jsonify(
+            {
+                "sensors": {
+                    name: SensorPoller.pollers[name].history.downsample(
+                        points, start, end
+                    )
+                    for name in names
+                }
+            }
+        )
+
+    @app.route("/sensors/readings")
+    def get_sensor_readings():
+        """A page of the stored sensor readings, filtered by any of the query arguments
+        Args (query):
+            start: Unix time of the oldest reading
+            end: Unix time of the newest reading
+            session: Only readings taken during this session
+            sensor: Only readings of this sensor
+            limit: Maximum readings in the page
+            after: The next cursor of the previous page
+        Returns:
+            dict: The matching readings, oldest first, and the cursor of the next page,
+            null on the last one
+        """
+        store = SensorPoller.store
+        if store is None:
+            return jsonify({"error": "Sensor readings aren't being stored"}), 404
+        limit = request.args.get("limit", READINGS_PAGE, type=int)
+        limit = max(1, min(limit, MAX_READINGS_PAGE))
+        after = request.args.get("after")
+        if after is not None:
+            try:
+                timestamp, rowid = after.split(":")
+                after = (float(timestamp), int(rowid))
+            except ValueError:
+                return jsonify({"error": f"Invalid cursor {after}"}), 400
+        readings, cursor = store.query(
+            start=request.args.get("start", type=float),
+            end=request.args.get("end", type=float),
+            session=request.args.get("session", type=int),
+            sensor=request.args.get("sensor"),
+            limit=limit,
+            after=after,
+        )
+        return jsonify(
+            {
+                "readings": readings,
+                "next": f"{cursor[0]!r}:{cursor[1]}" if cursor else None,
+            }
+        )
+
+    @app.route("/sensors/sessions/<int:session>")
+    def export_session_readings(session: int):
+        """Download every sensor reading taken during a session as CSV"""
+        store = SensorPoller.store
+        if store is None:
+            abort(404)
+        return stream_response(
+            store.export_session(session),
+            mimetype="text/csv",
+            headers={
+                "Content-Disposition": f"attachment; filename=sensors_{session}.csv"
+            },
+        )
+
     @app.route("/video/<int:index>")
     def get_video(index: int):
-        """Get the connection for generated frames
+        """Get the connection for generated frames. The query may ask for a smaller
+        ?width=, a lower JPEG ?quality= and a lower ?fps= than the camera's.
         Args:
             index: The camera index
         Returns:
@@ -52,22 +233,30 @@ def create(name: str) -> Flask:
             return Response()
 
         server = CameraThread.cameras[index]
-        return Response(
-            stream_with_context(server.generate_frames()),
+        fps = request.args.get("fps", type=float)
+        return stream_response(
+            server.generate_frames(
+                request.args.get("width", type=int),
+                request.args.get("quality", type=int),
+                fps if fps is not None and fps > 0 else None,
+            ),
             mimetype="multipart/x-mixed-replace; boundary=frame",
         )
 
+    @app.route("/metrics")
+    def get_metrics():
+        """Serve the timing histograms and camera counters for Prometheus"""
+        return Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
+
     @app.route("/photos")
     def get_photos():
-        """Get all the photos taken on the last execution
+        """Get the metadata of all the photos taken on the last execution
         Returns:
-            dict: All the photo contents stored by all cameras
+            dict: The URL and type of every photo stored by all cameras
         """
 
-        photos_dir = utils.get_session_dirpath(
-            config.CAM_DEST, states.get(states.SESSION)
-        )
-        formats = (".jpg", ".jpeg", ".png")
+        session = states.get(states.SESSION)
+        photos_dir = utils.get_session_dirpath(config.CAM_DEST, session)
         limits = {
             "RGBT": photos_taken.get(photos_taken.TOP),
             "RGB": photos_taken.get(photos_taken.SIDE),
@@ -85,60 +274,109 @@ def create(name: str) -> Flask:
                 {"photo_counts": limits, "photos": photos, "completed": False}
             )
 
-        # Get all image files and sort them newest to oldest
-        files = [
-            file for file in os.listdir(photos_dir) if file.lower().endswith(formats)
-        ]
-        files.sort(
-            key=lambda file: os.path.getctime(os.path.join(photos_dir, file)),
-            reverse=True,
-        )
-
-        if len(files) == 0:
+        latest = get_manifest(photos_dir).latest_run()
+        if len(latest) == 0:
             logging.error("Tried serving photos via API but there's none stored.")
             return jsonify(
                 {"photo_counts": limits, "photos": photos, "completed": True}
             )
 
-        latest_timestamp = utils.extract_photo_name(files[0])[1]
-        logging.debug(
-            "Latest timestamp found is [%s]. Found %d files.",
-            latest_timestamp,
-            len(files),
-        )
-        for file in files:
-            label, timestamp, step, ext = utils.extract_photo_name(file)
-            if timestamp != latest_timestamp:
-                continue
-
+        for label, entries in latest.items():
             if label not in photos:
-                logging.warning("Found a file with an unrecognized label: %s", file)
+                logging.warning("Found files with an unrecognized label: %s", label)
                 continue
 
-            full_path = os.path.join(photos_dir, file)
-            with open(full_path, "rb") as image_file:
-                content = base64.b64encode(image_file.read()).decode("utf-8")
-            utils.insert_array_padded(
-                photos[label],
-                int(step),
-                {
-                    "filename": file,
-                    "content": content,
-                    "content_type": "image/jpeg" if ext == "jpg" else "image/png",
-                },
-            )
+            photos[label] = [
+                entry
+                and {
+                    "filename": entry["file"],
+                    "url": f"/photos/{session}/{entry['file']}",
+                    "size": entry["size"],
+                    "content_type": entry["content_type"],
+                }
+                for entry in entries
+            ]
 
         return jsonify({"photo_counts": limits, "photos": photos, "completed": True})
 
-    @app.route("/session")
-    def get_session():
-        """Zip all of the CAM_DEST directory and return it"""
-        zipped = utils.zip_dir(config.CAM_DEST)
-        return Response(
-            zipped,
+    @app.route("/photos/<int:session>/<string:filename>")
+    def get_photo_file(session: int, filename: str):
+        """Serve a stored photo. Supports conditional and partial requests so the browser
+        can cache the images and load them lazily in parallel.
+        Args:
+            session: The number of the session the photo belongs to
+            filename: The name of the photo file
+        Returns:
+            The image file sent with ETag, Last-Modified and Range support
+        """
+        photos_dir = utils.get_session_dirpath(config.CAM_DEST, session, create=False)
+        if not filename.lower().endswith(PHOTO_FORMATS):
+            abort(404)
+        return send_from_directory(
+            photos_dir, filename, conditional=True, etag=True, max_age=PHOTO_MAX_AGE
+        )
+
+    def send_archive(sessions: list[int], filename: str) -> Response:
+        """Stream a zip of the sessions. Answers Range requests with the requested part
+        so an interrupted download can resume, unless If-Range names another archive.
+        """
+        archive = SessionArchive(config.CAM_DEST, sessions)
+        headers = {
+            "Accept-Ranges": "bytes",
+            "ETag": f'"{archive.etag}"',
+            "Content-Disposition": f"attachment; filename={filename}",
+        }
+        start, end, status = 0, archive.size, 200
+        if_range = request.if_range
+        if (
+            request.range is not None
+            and len(request.range.ranges) == 1
+            and (
+                (if_range.etag is None and if_range.date is None)
+                or if_range.etag == archive.etag
+            )
+        ):
+            span = request.range.range_for_length(archive.size)
+            if span is None:
+                headers["Content-Range"] = f"bytes */{archive.size}"
+                return Response(status=416, headers=headers)
+            (start, end), status = span, 206
+            headers["Content-Range"] = f"bytes {start}-{end - 1}/{archive.size}"
+        headers["Content-Length"] = str(end - start)
+        response = stream_response(
+            archive.stream(start, end),
+            status=status,
             mimetype="application/zip",
-            headers={"Content-Disposition": f"attachment; filename=all_sessions.zip"},
+            headers=headers,
         )
+        response.last_modified = archive.last_modified
+        return response
+
+    def stored_sessions() -> list[int]:
+        """The sessions on disk, except the one being captured or transferred"""
+        sessions = utils.list_sessions(config.CAM_DEST)
+        # A stopped session isn't complete until its Survey3 pictures were transferred
+        if data.get(data.RUNNING) or not states.get(states.TRANSFERRED):
+            sessions = [s for s in sessions if s != states.get(states.SESSION)]
+        return sessions
+
+    @app.route("/session")
+    def get_session():
+        """Zip every stored session, or only the ones after ?since=<session>. Supports
+        Range requests to resume the download.
+        """
+        since = request.args.get("since", type=int)
+        if since is None:
+            return send_archive(stored_sessions(), "all_sessions.zip")
+        sessions = [session for session in stored_sessions() if session > since]
+        return send_archive(sessions, f"sessions_after_{since}.zip")
+
+    @app.route("/session/<int:session>")
+    def get_session_archive(session: int):
+        """Zip a single session. Supports Range requests to resume the download."""
+        if session not in stored_sessions():
+            abort(404)
+        return send_archive([session], f"session_{session}.zip")
 
     @app.route("/session", methods=["DELETE"])
     def delete_session():
@@ -146,6 +384,8 @@ def create(name: str) -> Flask:
         try:
             shutil.rmtree(config.CAM_DEST)
             os.mkdir(config.CAM_DEST)
+            forget_manifests()
+            forget_crcs()
         except Exception as e:
             return jsonify({"ok": False, "reason": str(e)})
         return jsonify({"ok": True, "reason": ""})
@@ -153,5 +393,31 @@ def create(name: str) -> Flask:
     return app
 
 
-def run(app: Flask, host: str, port: int):
-    app.run(host=host, port=port, debug=False, use_reloader=False)
+def run(app: Flask, host: str, port: int, stop_event: threading.Event):
+    """Serve the API on waitress until stop_event is set. The open streams are ended and
+    the running requests get SHUTDOWN_TIMEOUT seconds to finish before every connection
+    is closed.
+    """
+    socket_map = {}
+    server = create_server(
+        app,
+        map=socket_map,
+        host=host,
+        port=port,
+        threads=SERVER_THREADS,
+        connection_limit=CONNECTION_LIMIT,
+        channel_timeout=KEEPALIVE_TIMEOUT,
+        outbuf_high_watermark=OUTBUF_HIGH_WATERMARK,
+    )
+
+    def shutdown():
+        stop_event.wait()
+        events.bus.close()
+        server.task_dispatcher.shutdown(timeout=SHUTDOWN_TIMEOUT)
+        # Closed from the server loop itself, which returns once no socket is left
+        server.trigger.pull_trigger(lambda: wasyncore.close_all(socket_map))
+
+    threading.Thread(target=shutdown, name="APIShutdown", daemon=True).start()
+    logging.info("Serving the API on http://%s:%d", host, port)
+    server.run()
+    logging.info("API stopped.")
@@ -0,0 +1,288 @@
+"""Zip archives of session directories that can be served in byte ranges.
+
+Every file is STORED, so the layout of an archive only depends on the names, sizes and
+modification times of its files. Its length, and the offset of every header and file, is
+known before reading any of them, which lets a download be resumed from any byte. The CRC
+of each file goes in its local header. It's taken from the session manifest, where the
+writer and the Survey3 transfer record it, or computed when the file is first sent and
+cached so resuming doesn't read the files before the range again.
+"""
+
+import hashlib
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from typing import Iterator, NamedTuple
+
+from manifest import read_entries
+
+CHUNK = 64 * 1024
+VERSION = 45  # 4.5, ZIP64
+FLAGS = 0x0800  # UTF-8 names
+ZIP32_LIMIT = 0xFFFFFFFF
+ENTRIES_LIMIT = 0xFFFF
+
+LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+ZIP64_OFFSET = struct.Struct("<HHQ")
+ZIP64_END = struct.Struct("<IQHHIIQQQQ")
+ZIP64_LOCATOR = struct.Struct("<IIQI")
+END = struct.Struct("<IHHHHIIH")
+
+
+class Member(NamedTuple):
+    """A file of the archive and where its local header starts"""
+
+    name: str
+    path: str
+    size: int
+    mtime_ns: int
+    offset: int
+    crc: int | None = None  # Recorded in the manifest when the file was written
+
+    @property
+    def encoded_name(self) -> bytes:
+        return self.name.encode("utf-8")
+
+    @property
+    def header_size(self) -> int:
+        return LOCAL_HEADER.size + len(self.encoded_name)
+
+    @property
+    def end(self) -> int:
+        return self.offset + self.header_size + self.size
+
+    def dos_time(self) -> tuple[int, int]:
+        """The modification time and date in MS-DOS format"""
+        t = time.localtime(self.mtime_ns / 1e9)
+        year = min(max(t.tm_year, 1980), 2107)
+        return (
+            t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2,
+            (year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday,
+        )
+
+
+crcs: dict[tuple[str, int, int], int] = {}
+crcs_lock = threading.Lock()
+
+
+def file_crc(member: Member) -> int:
+    """CRC-32 of a file, read only the first time it's needed"""
+    if member.crc is not None:
+        return member.crc
+    key = (member.path, member.size, member.mtime_ns)
+    with crcs_lock:
+        if key in crcs:
+            return crcs[key]
+    crc = 0
+    with open(member.path, "rb") as file:
+        while buffer := file.read(CHUNK):
+            crc = zlib.crc32(buffer, crc)
+    with crcs_lock:
+        crcs[key] = crc
+    return crc
+
+
+def forget_crcs():
+    """Drop every cached CRC, used after the session directories are deleted"""
+    with crcs_lock:
+        crcs.clear()
+
+
+class SessionArchive:
+    """Planned archive of some session directories, named by their path from the base"""
+
+    def __init__(self, base: str, sessions: list[int]):
+        """
+        Args:
+            base: The directory holding the numeric session directories
+            sessions: The sessions to include, missing ones are skipped
+        """
+        self.members: list[Member] = []
+        offset = 0
+        digest = hashlib.sha1()
+        for session in sorted(sessions):
+            dirname = str(session).zfill(8)
+            dirpath = os.path.join(base, dirname)
+            if not os.path.isdir(dirpath):
+                continue
+            entries = read_entries(dirpath)
+            for root, dirs, files in os.walk(dirpath):
+                dirs.sort()
+                for file in sorted(files):
+                    path = os.path.join(root, file)
+                    stat = os.stat(path)
+                    name = os.path.relpath(path, base).replace(os.sep, "/")
+                    entry = entries.get(file) if root == dirpath else None
+                    crc = None
+                    if entry is not None and entry.get("size") == stat.st_size:
+                        crc = entry.get("crc32")
+                    member = Member(
+                        name, path, stat.st_size, stat.st_mtime_ns, offset, crc
+                    )
+                    self.members.append(member)
+                    offset = member.end
+                    digest.update(
+                        f"{name}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode()
+                    )
+
+        self.central_offset = offset
+        self.central_size = sum(
+            CENTRAL_HEADER.size
+            + len(member.encoded_name)
+            + (ZIP64_OFFSET.size if member.offset >= ZIP32_LIMIT else 0)
+            for member in self.members
+        )
+        self.zip64 = (
+            len(self.members) >= ENTRIES_LIMIT
+            or self.central_offset >= ZIP32_LIMIT
+            or self.central_size >= ZIP32_LIMIT
+        )
+        self.size = (
+            self.central_offset
+            + self.central_size
+            + (ZIP64_END.size + ZIP64_LOCATOR.size if self.zip64 else 0)
+            + END.size
+        )
+        self.etag = digest.hexdigest()
+        self.last_modified = max(
+            (member.mtime_ns / 1e9 for member in self.members), default=time.time()
+        )
+
+    def local_header(self, member: Member) -> bytes:
+        mtime, mdate = member.dos_time()
+        return (
+            LOCAL_HEADER.pack(
+                0x04034B50,
+                VERSION,
+                FLAGS,
+                0,
+                mtime,
+                mdate,
+                file_crc(member),
+                member.size,
+                member.size,
+                len(member.encoded_name),
+                0,
+            )
+            + member.encoded_name
+        )
+
+    def central_directory(self) -> bytes:
+        """Central directory and end records, they need the CRC of every file"""
+        entries = []
+        for member in self.members:
+            mtime, mdate = member.dos_time()
+            extra = b""
+            offset = member.offset
+            if offset >= ZIP32_LIMIT:
+                extra = ZIP64_OFFSET.pack(0x0001, 8, offset)
+                offset = ZIP32_LIMIT
+            entries.append(
+                CENTRAL_HEADER.pack(
+                    0x02014B50,
+                    VERSION | 3 << 8,  # Made by Unix, so the permissions are kept
+                    VERSION,
+                    FLAGS,
+                    0,
+                    mtime,
+                    mdate,
+                    file_crc(member),
+                    member.size,
+                    member.size,
+                    len(member.encoded_name),
+                    len(extra),
+                    0,
+                    0,
+                    0,
+                    0o100644 << 16,
+                    offset,
+                )
+                + member.encoded_name
+                + extra
+            )
+
+        records = []
+        count = len(self.members)
+        if self.zip64:
+            zip64_end = self.central_offset + self.central_size
+            records.append(
+                ZIP64_END.pack(
+                    0x06064B50,
+                    ZIP64_END.size - 12,
+                    VERSION,
+                    VERSION,
+                    0,
+                    0,
+                    count,
+                    count,
+                    self.central_size,
+                    self.central_offset,
+                )
+            )
+            records.append(ZIP64_LOCATOR.pack(0x07064B50, 0, zip64_end, 1))
+        records.append(
+            END.pack(
+                0x06054B50,
+                0,
+                0,
+                min(count, ENTRIES_LIMIT),
+                min(count, ENTRIES_LIMIT),
+                min(self.central_size, ZIP32_LIMIT),
+                min(self.central_offset, ZIP32_LIMIT),
+                0,
+            )
+        )
+        return b"".join(entries + records)
+
+    def read_file(self, member: Member, start: int, end: int) -> Iterator[bytes]:
+        """Bytes start to end of a file, which must not have changed since planned"""
+        with open(member.path, "rb") as file:
+            if os.fstat(file.fileno()).st_mtime_ns != member.mtime_ns:
+                raise OSError(f"{member.name} changed while being archived")
+            file.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                buffer = file.read(min(CHUNK, remaining))
+                if not buffer:
+                    raise OSError(f"{member.name} shrank while being archived")
+                remaining -= len(buffer)
+                yield buffer
+
+    def stream(self, start: int = 0, end: int | None = None) -> Iterator[bytes]:
+        """Generator of the bytes of the archive from start up to end, exclusive
+        Args:
+            start: Offset of the first byte
+            end: Offset after the last byte, the end of the archive if None
+        """
+        end = self.size if end is None else min(end, self.size)
+        try:
+            for member in self.members:
+                if member.end <= start:
+                    continue
+                if member.offset >= end:
+                    return
+                data_offset = member.offset + member.header_size
+                if start < data_offset:
+                    header = self.local_header(member)
+                    yield header[
+                        max(start, member.offset) - member.offset : end - member.offset
+                    ]
+                if end > data_offset:
+                    yield from self.read_file(
+                        member,
+                        max(start, data_offset) - data_offset,
+                        min(end, member.end) - data_offset,
+                    )
+            if end > self.central_offset:
+                yield self.central_directory()[
+                    max(start, self.central_offset)
+                    - self.central_offset : end
+                    - self.central_offset
+                ]
+        except OSError as e:
+            # The response is already on its way, cutting it short is all that's left
+            logging.error("Archive stream aborted. %s", e)
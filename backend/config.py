@@ -9,6 +9,13 @@ API_PORT = int(os.getenv("API_PORT", "5000"))
 CAM_DEST = os.getenv("CAM_DEST", "/home/sise/Desktop/Fenotipado")
 AP_SSID = os.environ["AP_SSID"]
 WIFI_PORT = int(os.environ["WIFI_PORT"])
+SENSOR_DB = os.getenv(
+    "SENSOR_DB", os.path.join(os.path.dirname(os.path.abspath(CAM_DEST)), "sensors.db")
+)
+# Format of the stills of each camera, see modules.writer.parse_encoders
+STILL_ENCODERS = os.getenv("STILL_ENCODERS", "RGB=png:1,RGBT=png:1")
+# "real" on the chamber, "sim" to run sessions against the simulated hardware
+HARDWARE = os.getenv("HARDWARE", "real")
 
 logging.basicConfig(
     format=(
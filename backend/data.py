@@ -1,35 +1,115 @@
+import json
 import threading
-
-import digitalio
+from types import MappingProxyType
+from typing import Callable
 
 import config, utils
+from events import bus
+from hardware import digitalio
+
+
+class Snapshot:
+    """Immutable view of the values at a version, shared by every reader"""
+
+    __slots__ = ("version", "values", "encoded")
+
+    def __init__(self, version: int, values: dict):
+        self.version = version
+        self.values = MappingProxyType(values)
+        self.encoded: str | None = None
+
+    def json(self) -> str:
+        """The values serialized as JSON, encoded once per version"""
+        if self.encoded is None:
+            self.encoded = json.dumps(dict(self.values))
+        return self.encoded
 
 
 class DataManager:
+    """Copy-on-write store. Writers replace the snapshot under a lock and bump the
+    version, readers just take the current snapshot without locking.
+    """
+
     def __init__(self, data: dict) -> None:
         self.lock = threading.Lock()
-        self.data = data
+        self.current = Snapshot(0, dict(data))
+        self.listeners: list[Callable[[dict, int], None]] = []
+
+    @property
+    def version(self) -> int:
+        return self.current.version
 
     def get(self, key: str):
-        with self.lock:
-            return self.data[key]
+        return self.current.values[key]
 
     def set(self, key, value, use_value: bool = True):
+        if not self.is_key(key):
+            return False
+        self.update_many({key: value if use_value else 0})
+        return True
+
+    def update_many(self, values: dict) -> dict:
+        """Set several keys at once, with a single new version
+        Args:
+            values: The new value of each key, all of them must exist
+        Returns:
+            The keys whose value changed
+        """
         with self.lock:
-            if self.is_key(key):
-                self.data[key] = value if use_value else 0
-            return self.is_key(key)
+            current = self.current.values
+            unknown = values.keys() - current.keys()
+            if unknown:
+                raise KeyError(f"Unknown keys {unknown}")
+            changes = {
+                key: value for key, value in values.items() if current[key] != value
+            }
+            self.commit(changes)
+        return changes
+
+    def increment(self, key: str, amount=1):
+        """Add to a value atomically
+        Returns:
+            The new value
+        """
+        with self.lock:
+            value = self.current.values[key] + amount
+            self.commit({key: value})
+        return value
 
     def add(self, key, value):
-        original = self.get(key)
-        return self.set(key, original + value)
+        self.increment(key, value)
+        return True
+
+    def commit(self, changes: dict):
+        """Publish a new snapshot with the changes. Must hold the lock, listeners are
+        called with it so they receive the versions in order
+        """
+        if not changes:
+            return
+        values = dict(self.current.values)
+        values.update(changes)
+        self.current = Snapshot(self.current.version + 1, values)
+        for listener in self.listeners:
+            listener(changes, self.current.version)
 
     def is_key(self, key: str):
-        return key in self.data
+        return key in self.current.values
+
+    def on_change(self, listener: Callable[[dict, int], None]):
+        """Call listener(changes, version) after every update that changes a value.
+        Listeners must be quick and must not write to this manager
+        """
+        self.listeners.append(listener)
 
     def get_data(self):
-        with self.lock:
-            return dict(self.data)
+        """Read-only mapping of the current values, never modified afterwards"""
+        return self.current.values
+
+    def snapshot(self) -> Snapshot:
+        return self.current
+
+    def changed_since(self, version: int) -> bool:
+        return self.current.version != version
 
 
 class Data(DataManager):
@@ -43,10 +123,10 @@ class Data(DataManager):
     PROGRESS = "progress"
     initialized = False
 
-    def set(self, key, value, use_value: bool = True):
-        if key == Data.RUNNING and value == 1 and not self.get(Data.RUNNING):
+    def update_many(self, values: dict) -> dict:
+        if values.get(Data.RUNNING) == 1 and not self.get(Data.RUNNING):
             self.run_pre_session()
-        return super().set(key, value, use_value)
+        return super().update_many(values)
 
     def init_values(self, dir_switch: digitalio.DigitalInOut, motor_steps: int):
         self.dir_switch = dir_switch
@@ -65,6 +145,13 @@ class Data(DataManager):
         data.set(data.PROGRESS, 0)
         if states.get(states.DIRECTION):
             states.set(states.ANGLE, self.motor_steps - 1)
+        bus.publish(
+            "session_started",
+            {
+                "session": states.get(states.SESSION),
+                "direction": states.get(states.DIRECTION),
+            },
+        )
 
 
 data = Data(
@@ -112,3 +199,6 @@ class Photos(DataManager):
 
 
 photos_taken = Photos({Photos.SIDE: 0, Photos.TOP: 0, Photos.IR: 0, Photos.UV: 0})
+
+# Dashboard clients get every change pushed instead of polling for it
+data.on_change(bus.change)
@@ -0,0 +1,120 @@
+"""Server-Sent Events channel pushing dashboard changes and session events to clients"""
+
+import json
+import threading
+from typing import Callable
+from collections import deque
+
+KEEPALIVE = 15.0
+EVENT_BACKLOG = 64
+DASHBOARD = "dashboard"
+
+
+class Listener:
+    """Queue of pending events of a single client. Consecutive dashboard changes are
+    merged so a slow client only receives the latest value of each key.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.pending: deque[tuple[str, dict]] = deque(maxlen=EVENT_BACKLOG)
+        self.closed = False
+
+    def put(self, event: str, payload: dict):
+        with self.condition:
+            if event == DASHBOARD and self.pending and self.pending[-1][0] == DASHBOARD:
+                self.pending[-1][1].update(payload)
+            else:
+                self.pending.append((event, dict(payload)))
+            self.condition.notify()
+
+    def take(self, timeout: float) -> list[tuple[str, dict]]:
+        """Wait for pending events and return all of them, empty if none came in time"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.pending or self.closed, timeout)
+            events = list(self.pending)
+            self.pending.clear()
+            return events
+
+    def close(self):
+        """Wake the client up so its stream ends"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+
+class EventBus:
+    """Fans out every published event to the connected listeners"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.listeners: set[Listener] = set()
+        self.closed = False
+
+    def publish(self, event: str, payload: dict):
+        with self.lock:
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener.put(event, payload)
+
+    def change(self, changes: dict, version: int):
+        """Change callback of DataManager, pushes the changed keys only"""
+        self.publish(DASHBOARD, changes)
+
+    def close(self):
+        """End every open stream, used when the server shuts down"""
+        with self.lock:
+            self.closed = True
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener.close()
+
+    def stream(self, snapshot: Callable[[], dict] | None = None):
+        """Generator of the SSE messages of a single client
+        Args:
+            snapshot: Called once the client listens, its result is sent first as a
+                dashboard event so the client starts up to date without missing a change
+        """
+        listener = Listener()
+        with self.lock:
+            if self.closed:
+                return
+            self.listeners.add(listener)
+        try:
+            state = snapshot() if snapshot is not None else None
+            # Tell the browser to retry quickly if the connection drops
+            yield "retry: 2000\n\n"
+            if state is not None:
+                yield format_event(DASHBOARD, state)
+            while not listener.closed:
+                events = listener.take(KEEPALIVE)
+                if not events:
+                    yield ": keepalive\n\n"
+                for event, payload in events:
+                    yield format_event(event, payload)
+        finally:
+            with self.lock:
+                self.listeners.discard(listener)
+
+
+def publish_photo(session: int, entry: dict | None):
+    """Announce a photo that was just stored, with the URL the API serves it from"""
+    if entry is None:
+        return
+    bus.publish(
+        "photo_saved",
+        {
+            "session": session,
+            "file": entry["file"],
+            "label": entry["label"],
+            "step": entry["step"],
+            "url": f"/photos/{session}/{entry['file']}",
+        },
+    )
+
+
+def format_event(event: str, payload: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+
+bus = EventBus()
@@ -0,0 +1,71 @@
+"""Hardware layer of the chamber, either the real devices or a simulation of them.
+
+Set the HARDWARE environment variable to "sim" to run whole sessions off-device, every
+sensor, pin, camera and the motor are replaced by the stand-ins of modules.simulated.
+"""
+
+import os
+import time
+
+import config
+
+SIMULATED = config.HARDWARE == "sim"
+
+if SIMULATED:
+    from modules import simulated
+    from modules.simulated import (  # pylint: disable=unused-import
+        adafruit_bh1750,
+        adafruit_dht,
+        adafruit_ltr390,
+        adafruit_tsl2561,
+        board,
+        busio,
+        digitalio,
+    )
+    from modules.simulated import SH1106 as sh1106
+    from modules.simulated import luma_i2c as lumaI2C
+    from modules.simulated import PacketHandler, PortHandler, VideoCapture
+
+    SD_ROOT = simulated.create_sd_root()
+    CAM_SRC_RGN = os.path.join(SD_ROOT, "0000-0001", "DCIM", "Photo")
+    CAM_SRC_RE = os.path.join(SD_ROOT, "0000-00011", "DCIM", "Photo")
+else:
+    import adafruit_bh1750  # pylint: disable=unused-import
+    import adafruit_dht  # pylint: disable=unused-import
+    import adafruit_ltr390  # pylint: disable=unused-import
+    import adafruit_tsl2561  # pylint: disable=unused-import
+    import board
+    import busio  # pylint: disable=unused-import
+    import digitalio
+    from cv2 import VideoCapture  # pylint: disable=no-name-in-module
+    from dynamixel_sdk import PacketHandler, PortHandler  # type: ignore
+    from luma.core.interface.serial import i2c as lumaI2C
+    from luma.oled.device import sh1106
+
+    CAM_SRC_RGN = "/media/sise/0000-0001/DCIM/Photo"
+    CAM_SRC_RE = "/media/sise/0000-00011/DCIM/Photo"
+
+
+def survey3_trigger(pin, origin: str):
+    """Create the output pin that triggers a Survey3 camera
+    Args:
+        pin: The board pin wired to the PWM input of the camera
+        origin: The photo directory of the camera once its SD card is mounted
+    """
+    if SIMULATED:
+        return simulated.Survey3Trigger(pin, origin)
+    return digitalio.DigitalInOut(pin)
+
+
+def send_pulse(pin, width: float):
+    """Send a single pulse through an output pin, blocking while it lasts
+    Args:
+        pin: The output pin
+        width: Seconds the pin stays high
+    """
+    if SIMULATED:
+        pin.pulse(width)
+        return
+    pin.value = True
+    time.sleep(width)
+    pin.value = False
@@ -3,32 +3,46 @@
 import threading
 import time
 import logging
+from concurrent.futures import ThreadPoolExecutor
 import config
 import requests
 
-import adafruit_bh1750
-import adafruit_dht
-import adafruit_ltr390
-import adafruit_tsl2561
-import board
-import busio
-import digitalio
-from luma.core.interface.serial import i2c as lumaI2C
-from luma.oled.device import sh1106
 from PIL import Image, ImageDraw, ImageFont
 import api
+import events
+import metrics
 from data import data, states, photos_taken
+from hardware import (
+    CAM_SRC_RE,
+    CAM_SRC_RGN,
+    adafruit_bh1750,
+    adafruit_dht,
+    adafruit_ltr390,
+    adafruit_tsl2561,
+    board,
+    busio,
+    digitalio,
+    lumaI2C,
+    sh1106,
+    survey3_trigger,
+)
 
 import utils
 from modules.ax12 import Ax12
 from modules.camera import CameraThread
+from modules.i2cbus import SENSOR, i2c_bus
+from modules.oled import PagedDisplay
+from modules.sensors import SensorPoller
 from modules.survey3 import Survey3
+from modules.writer import parse_encoders
+from scheduler import Scheduler
+from sensorstore import SensorStore
 
 # Pin I/O
 i2c = busio.I2C(board.SCL, board.SDA)
 DHT_PIN = board.D26
-RE_CAMERA = digitalio.DigitalInOut(board.D23)
-RGN_CAMERA = digitalio.DigitalInOut(board.D24)
+RE_CAMERA = survey3_trigger(board.D23, CAM_SRC_RE)
+RGN_CAMERA = survey3_trigger(board.D24, CAM_SRC_RGN)
 WHITE_LIGHT = digitalio.DigitalInOut(board.D27)
 UV_LIGHT = digitalio.DigitalInOut(board.D22)
 IR_LIGHT = digitalio.DigitalInOut(board.D17)
@@ -47,18 +61,30 @@ for pin in [START_BTN, STOP_BTN, DIR_SWITCH]:
 CAM_RGB_INDEX = 0
 CAM_RGBT_INDEX = 2
 CONNECTION_URL = f"http://127.0.0.1:{config.WIFI_PORT}/active"
-CAM_SRC_RGN = "/media/sise/0000-0001/DCIM/Photo"
-CAM_SRC_RE = "/media/sise/0000-00011/DCIM/Photo"
 CAM_DEST = config.CAM_DEST
 DXL_DEVICENAME = "/dev/ttyAMA0"
 DXL_BAUDRATE = 1_000_000
 DXL_ID = 1
 DXL_SPEED = 50
 MOTOR_STEPS = 6
+# Maximum time the motor may take to arrive, it's usually done much sooner
 MOTOR_STEP_TIME = 2
 MOTOR_RESET_TIME = MOTOR_STEPS * MOTOR_STEP_TIME
+MOTOR_TOLERANCE = 4
+MOTOR_POLL_TIME = 0.05
+MOTOR_SETTLE_TIME = 0.2
+# The RGB stills are the sharpest of a burst, which may take BURST_TIME of the step
+BURST_FRAMES = 3
+BURST_TIME = 0.5
+LIGHT_SETTLE_TIME = 1
+DISMOUNT_TIME = 5
+TRANSFER_POLL_TIME = 0.5
+TRANSFER_PROGRESS = 10
 ANGLES = [round(i * (300 / (MOTOR_STEPS - 1))) for i in range(MOTOR_STEPS)]
-SENSOR_READ_TIME = 1
+# The DHT22 can't be sampled more often than every 2 s
+DHT_READ_TIME = 2
+LIGHT_READ_TIME = 1
+LIGHT_READ_TIME_ACTIVE = 0.2
 DISPLAY_UPDATE_TIME = 0.2
 WIFI_CHECK_TIME = 5
 TOTAL_CAMERAS = 4
@@ -75,7 +101,7 @@ dxl.set_moving_speed(DXL_SPEED)
 dxl.set_goal_position(0)
 dht = adafruit_dht.DHT22(DHT_PIN, use_pulseio=False)
 try:
-    display = sh1106(lumaI2C(address=0x3C))
+    display = PagedDisplay(sh1106(lumaI2C(address=0x3C)))
 except Exception as e:
     logging.warning("Display SH1106 not recognized in I2C bus on address 0x3C. %s", e)
     display = None
@@ -97,8 +123,11 @@ except ValueError:
     logging.warning("Sensor LTR390 not recognized in I2C bus.")
     ltr = None
 stop_event = threading.Event()
+scheduler = Scheduler()
+SensorPoller.store = SensorStore(config.SENSOR_DB, stop_event)
+CameraThread.encoders = parse_encoders(config.STILL_ENCODERS)
 side_cam = CameraThread("RGB", CAM_RGB_INDEX, stop_event, 800, 600)
-top_cam = CameraThread("RGBT", CAM_RGBT_INDEX, stop_event, 848, 480)
+top_cam = CameraThread("RGBT", CAM_RGBT_INDEX, stop_event, 848, 480, 424, 240)
 re_camera = Survey3(RE_CAMERA, "RE", CAM_SRC_RE, CAM_DEST)
 rgn_camera = Survey3(RGN_CAMERA, "RGN", CAM_SRC_RGN, CAM_DEST)
 
@@ -112,30 +141,50 @@ times = {"rotation_start": 0.0, "sensor_read": 0.0, "process_start": 0.0}
 # Thread functions
 def start_api():
     """Start the Flask API server in a separate thread."""
-    api.run(app, "0.0.0.0", config.API_PORT)
-
-
-def read_sensor_data():
-    """Read data from the sensors and update the global data dictionary."""
-    has_dht = True
-    dht_read = 0
-    while not stop_event.is_set():
-        try:
-            dht.measure()
-            if dht.temperature is None or dht.humidity is None:
-                raise Exception("Succeeded reading. Read None")
-            has_dht = True
-        except Exception as e:
-            if has_dht:
-                logging.warning("Sensor DHT11 not recognized. %s", e)
-            has_dht = False
-
-        data.set(data.TEMP, dht.temperature, has_dht)
-        data.set(data.HUM, dht.humidity, has_dht)
-        data.set(data.WHITE_LUX, round(bh.lux, 1) if bh else -1)
-        data.set(data.IR_LUX, round(tsl.infrared, 1) if tsl else -1)
-        data.set(data.UV_LUX, round(ltr.uvi, 1) if ltr else -1)
-        time.sleep(SENSOR_READ_TIME)
+    api.run(app, "0.0.0.0", config.API_PORT, stop_event)
+
+
+def read_dht() -> dict:
+    """Bit-banged read of the DHT22, slow and failing now and then"""
+    dht.measure()
+    if dht.temperature is None or dht.humidity is None:
+        raise Exception("Succeeded reading. Read None")
+    return {data.TEMP: dht.temperature, data.HUM: dht.humidity}
+
+
+def create_sensor_pollers() -> list[SensorPoller]:
+    """A poller per sensor so the slow DHT22 never delays the I2C light sensors"""
+    pollers = [
+        SensorPoller(
+            "dht22",
+            [data.TEMP, data.HUM],
+            read_dht,
+            DHT_READ_TIME,
+            DHT_READ_TIME,
+            stop_event,
+            fallback={data.TEMP: 0, data.HUM: 0},
+        )
+    ]
+    light_sensors = [
+        ("bh1750", bh, data.WHITE_LUX, lambda: bh.lux),
+        ("tsl2561", tsl, data.IR_LUX, lambda: tsl.infrared),
+        ("ltr390", ltr, data.UV_LUX, lambda: ltr.uvi),
+    ]
+    for name, sensor, key, read in light_sensors:
+        if sensor is None:
+            data.set(key, -1)
+            continue
+        pollers.append(
+            SensorPoller(
+                name,
+                [key],
+                lambda key=key, read=read: {key: round(i2c_bus.call(SENSOR, read), 1)},
+                LIGHT_READ_TIME,
+                LIGHT_READ_TIME_ACTIVE,
+                stop_event,
+            )
+        )
+    return pollers
 
 
 def connection_check():
@@ -160,27 +209,27 @@ def connection_check():
 
 
 def update_display():
-    """Update the frame in the OLED display"""
+    """Update the frame in the OLED display, only redrawn when its text changes"""
+    shown = None
     while not stop_event.is_set():
         if display is None:
             time.sleep(DISPLAY_UPDATE_TIME)
             continue
 
-        field_mode = bh is None and tsl is None and ltr is None
-        image = Image.new("1", (display.width, display.height))
-        draw = ImageDraw.Draw(image)
-
-        content = [
+        content = (
             f"AP: {config.AP_SSID if ap_conn['active'] else 'OFF'}",
             f"http://{ap_conn['ip']}:{ap_conn['port']}/" if ap_conn['active'] else "NO AP URL (OK)",
             f"Sentido: {'ANTIHORARIO' if states.get(states.DIRECTION) else 'HORARIO'}",
             f"Estado: {'ON' if data.get(data.RUNNING) else 'OFF'} | {data.get(data.PROGRESS)}%",
-        ]
-        line = display.height // len(content)
-
-        for i in range(len(content)):
-            draw.text((0, line * i), content[i], font=display_font, fill=255)
-        display.display(image)
+        )
+        if content != shown:
+            image = Image.new("1", (display.width, display.height))
+            draw = ImageDraw.Draw(image)
+            line = display.height // len(content)
+            for i in range(len(content)):
+                draw.text((0, line * i), content[i], font=display_font, fill=255)
+            display.display(image)
+            shown = content
         time.sleep(DISPLAY_UPDATE_TIME)
 
 
@@ -204,14 +253,27 @@ def update_progress(angle_index: int, prev_camera: int, completed=False):
     data.set(
         data.PROGRESS,
         round(
-            ((step / MOTOR_STEPS) + (prev_camera / TOTAL_CAMERAS) / MOTOR_STEPS) * 99
+            ((step / MOTOR_STEPS) + (prev_camera / TOTAL_CAMERAS) / MOTOR_STEPS)
+            * (99 - TRANSFER_PROGRESS)
         ),
     )
     logging.info("Changed progress to %d%%", data.get(data.PROGRESS))
 
 
+def update_transfer_progress(fraction: float):
+    """Fill the last part of the progress bar with the transfer of the Survey3 pictures
+    Args:
+        fraction: The fraction of the bytes already transferred
+    """
+    progress = round(99 - TRANSFER_PROGRESS + fraction * TRANSFER_PROGRESS)
+    if progress != data.get(data.PROGRESS):
+        data.set(data.PROGRESS, progress)
+        logging.info("Changed progress to %d%%", progress)
+
+
+@metrics.timed("toggle_lights")
 def toggle_lights(state_white: bool, state_ir: bool, state_uv: bool):
-    """Toggle the state of all the lights
+    """Toggle the state of all the lights. The caller waits LIGHT_SETTLE_TIME if needed
     Args:
         state_white: The new state of the white LEDs
         state_ir: The new state of the infrarred LEDs
@@ -220,152 +282,236 @@ def toggle_lights(state_white: bool, state_ir: bool, state_uv: bool):
     WHITE_LIGHT.value = state_white
     IR_LIGHT.value = state_ir
     UV_LIGHT.value = state_uv
-    time.sleep(1)
 
 
-def move_motor_next():
+@metrics.timed("move_motor_next")
+def move_motor_next() -> tuple[int, float]:
     """Order the motor to move to the next angle, update roation start time
-    If it's moving to the starting position block the main thread and update starting time
+    Returns:
+        The goal position in bytes and the maximum seconds the motor may need to arrive,
+        longer if it's moving to the starting position
     """
+    if is_first_step():
+        # The RAM of the motor resets if it lost power between sessions
+        dxl.clear_cache()
     dxl.set_moving_speed(DXL_SPEED)
     logging.info(f"{states.get(states.ANGLE)}")
     angle = ANGLES[states.get(states.ANGLE)]
-    logging.info(
-        "Began moving towards %d° (%d in bytes).", angle, utils.degree_to_byte(angle)
-    )
-    dxl.set_goal_position(utils.degree_to_byte(angle))
+    goal = utils.degree_to_byte(angle)
+    logging.info("Began moving towards %d° (%d in bytes).", angle, goal)
+    dxl.set_goal_position(goal)
+    if Ax12.VERIFY:
+        dxl.verify()
     data.set(data.ANGLE, angle)
 
     times["rotation_start"] = time.time()
-    if (states.get(states.ANGLE) == 0 or states.get(states.ANGLE) == MOTOR_STEPS - 1) and data.get(data.PROGRESS) == 0:
-        time.sleep(MOTOR_RESET_TIME)
+    if is_first_step():
+        return goal, MOTOR_RESET_TIME
+    return goal, MOTOR_STEP_TIME
+
+
+def is_first_step() -> bool:
+    """Whether the session hasn't taken any picture yet"""
+    return (
+        states.get(states.ANGLE) == 0 or states.get(states.ANGLE) == MOTOR_STEPS - 1
+    ) and data.get(data.PROGRESS) == 0
+
+
+@metrics.timed("acquisition_step")
+def acquisition_step():
+    """Scheduler task for a single step of the session.
+    The white lights settle while the motor moves and both Survey3 cameras are triggered
+    at the same time. The RGB images are written in the background while the next step
+    already starts rotating.
+    """
+    angle_index = states.get(states.ANGLE)
+    logging.info("Step %d / %d started.", angle_index, MOTOR_STEPS)
+    first_step = is_first_step()
+
+    goal, timeout = move_motor_next()
+    toggle_lights(True, False, False)
+    lights_ready = time.monotonic() + LIGHT_SETTLE_TIME
+    yield scheduler.spawn(
+        "motor", dxl.arrival_task(goal, MOTOR_TOLERANCE, timeout, MOTOR_POLL_TIME)
+    )
+    # The cameras change to the still resolution while the motor and lights settle
+    ready = max(time.monotonic() + MOTOR_SETTLE_TIME, lights_ready)
+    stills = [
+        scheduler.spawn("still", side_cam.still_task(ready, BURST_FRAMES, BURST_TIME)),
+        scheduler.spawn("still", top_cam.still_task(ready, BURST_FRAMES, BURST_TIME)),
+    ]
+    for still in stills:
+        yield still
+    if first_step:
         times["process_start"] = time.time()
 
+    logging.info("Taking RGB Side picture...")
+    frame, metadata = stills[0].result
+    photos_taken.increment(photos_taken.SIDE, 1)
+    if frame is not None:
+        side_cam.save_image(
+            CAM_DEST, frame, times["process_start"], angle_index, metadata
+        )
+    update_progress(angle_index, 1)
+
+    logging.info("Taking RGB Top picture...")
+    frame_top, metadata_top = stills[1].result
+    photos_taken.increment(photos_taken.TOP, 1)
+    if frame_top is not None:
+        top_cam.save_image(
+            CAM_DEST, frame_top, times["process_start"], angle_index, metadata_top
+        )
+    update_progress(angle_index, 2)
+
+    logging.info("Taking RE and RGN pictures...")
+    toggle_lights(False, True, False)
+    yield LIGHT_SETTLE_TIME
+    reads = [
+        scheduler.spawn("survey3_read", re_camera.read_task()),
+        scheduler.spawn("survey3_read", rgn_camera.read_task()),
+    ]
+    for read in reads:
+        yield read
+    photos_taken.increment(photos_taken.IR, 1)
+    photos_taken.increment(photos_taken.UV, 1)
+    update_progress(angle_index, 4)
+    states.set(states.TRANSFERRED, False)
+
+    logging.info("Updating end of loop states...")
+    toggle_lights(False, False, False)
+    states.set(states.ROTATED, True)
+    if states.get(states.DIRECTION):
+        states.increment(states.ANGLE, -1)
+    else:
+        states.increment(states.ANGLE)
+
 
-def main():
-    """Main function to handle the chamber operations."""
+@metrics.timed("transfer_session")
+def transfer_session():
+    """Scheduler task moving the Survey3 pictures to the session directory"""
+    angle_index = states.get(states.ANGLE)
+    # Counter-clockwise sessions count down from the last angle
+    steps = (
+        MOTOR_STEPS - angle_index - 1 if states.get(states.DIRECTION) else angle_index
+    )
+    session = states.get(states.SESSION)
+    process_start = times["process_start"]
+    logging.info("Began transferring %d images from the cameras.", steps)
+
+    logging.info("Dismounting cameras")
+    mounts = [
+        scheduler.spawn("survey3_mount", re_camera.toggle_mount_task()),
+        scheduler.spawn("survey3_mount", rgn_camera.toggle_mount_task()),
+    ]
+    for mount in mounts:
+        yield mount
+    yield DISMOUNT_TIME
+
+    logging.info("Began transferring pictures")
+    cameras = [re_camera, rgn_camera]
+    progress = utils.TransferProgress(
+        sum(camera.pending_bytes(steps) for camera in cameras)
+    )
+    # Each SD card is a separate device, copy from both at the same time
+    with ThreadPoolExecutor(max_workers=len(cameras)) as pool:
+        transfers = {
+            camera: pool.submit(
+                camera.transfer_n, steps, session, process_start, progress
+            )
+            for camera in cameras
+        }
+        while not all(transfer.done() for transfer in transfers.values()):
+            update_transfer_progress(progress.fraction())
+            yield TRANSFER_POLL_TIME
+    update_transfer_progress(progress.fraction())
+    logging.info("Transferred %d bytes.", progress.done)
+
+    verified = True
+    for camera, transfer in transfers.items():
+        if transfer.exception() is None and transfer.result():
+            camera.clear_sd()
+        else:
+            verified = False
+            logging.error("Kept the SD card of %s, its transfer failed.", camera.id)
+
+    logging.info("Mounting back cameras")
+    mounts = [
+        scheduler.spawn("survey3_mount", re_camera.toggle_mount_task()),
+        scheduler.spawn("survey3_mount", rgn_camera.toggle_mount_task()),
+    ]
+    for mount in mounts:
+        yield mount
+
+    logging.info("Waiting for the RGB images to be written")
+    yield lambda: CameraThread.writer.flush(timeout=0)
+
+    update_progress(steps, 4, True)
+    states.set(states.ANGLE, 0)
+    states.set(states.TRANSFERRED, True)
+    data.set(data.RUNNING, False)
+    events.bus.publish("transfer_completed", {"session": session, "verified": verified})
+
+
+def main() -> float:
+    """Main function to handle the chamber operations.
+    Returns:
+        The seconds until the scheduled tasks need to run again
+    """
     new_start = utils.debounce_button(START_BTN, states.get(states.START))
     new_stop = utils.debounce_button(STOP_BTN, states.get(states.STOP))
 
     if data.get(data.RUNNING):
         data.set(data.RUNNING, not (new_stop and not states.get(states.STOP)))
-    else:
+    elif not scheduler.busy("transfer"):
         data.set(data.RUNNING, new_start and not states.get(states.START))
 
-    if data.get(data.RUNNING):
-        if states.get(states.ROTATED):
-            move_motor_next()
-            states.set(
-                states.ROTATED, False
-            )
-
-        if time.time() - times["rotation_start"] > MOTOR_STEP_TIME:
-            logging.info("Step %d / %d started.", states.get(states.ANGLE), MOTOR_STEPS)
-
-            toggle_lights(True, False, False)
-            logging.info("Taking RGB Side picture...")
-            frame = side_cam.get_frame()
-            photos_taken.add(photos_taken.SIDE, 1)
-            if frame is not None:
-                side_cam.save_image(
-                    CAM_DEST, frame, times["process_start"], states.get(states.ANGLE)
-                )
-            update_progress(states.get(states.ANGLE), 1)
-
-            logging.info("Taking RGB Top picture...")
-            frame_top = top_cam.get_frame()
-            photos_taken.add(photos_taken.TOP, 1)
-            if frame_top is not None:
-                top_cam.save_image(
-                    CAM_DEST,
-                    frame_top,
-                    times["process_start"],
-                    states.get(states.ANGLE),
-                )
-            update_progress(states.get(states.ANGLE), 2)
-
-            logging.info("Taking RE and RGN pictures...")
-            toggle_lights(False, True, False)
-            re_camera.read()
-            rgn_camera.read()
-            photos_taken.add(photos_taken.IR, 1)
-            photos_taken.add(photos_taken.UV, 1)
-            update_progress(states.get(states.ANGLE), 4)
-            states.set(states.TRANSFERRED, False)
-
-            #toggle_lights(False, False, True)
-            #update_progress(states.get(states.ANGLE), 4)
-
-            logging.info("Updating end of loop states...")
-            states.set(states.ROTATED, True)
-            if states.get(states.DIRECTION):
-                states.add(states.ANGLE, -1)
-            else:
-                states.add(states.ANGLE, 1)
-            toggle_lights(False, False, False)
-
     completed_steps = (
         states.get(states.ANGLE) >= MOTOR_STEPS or states.get(states.ANGLE) < 0
     )
-    if not states.get(states.TRANSFERRED) and (
-        completed_steps or not data.get(data.RUNNING)
-    ):
-        logging.info(
-            "Began transferring %d images from the cameras.", states.get(states.ANGLE)
-        )
-
-        logging.info("Dismounting cameras")
-        re_camera.toggle_mount()
-        rgn_camera.toggle_mount()
-        time.sleep(5)
-
-        logging.info("Began transferring pictures")
-        re_camera.transfer_n(
-            states.get(states.ANGLE), states.get(states.SESSION), times["process_start"]
-        )
-        rgn_camera.transfer_n(
-            states.get(states.ANGLE), states.get(states.SESSION), times["process_start"]
-        )
-        re_camera.clear_sd()
-        rgn_camera.clear_sd()
-
-        logging.info("Mounting back cameras")
-        re_camera.toggle_mount()
-        rgn_camera.toggle_mount()
-
-        update_progress(states.get(states.ANGLE), 4, True)
-        states.set(states.ANGLE, 0)
-        states.set(states.TRANSFERRED, True)
-        data.set(data.RUNNING, False)
+    if not scheduler.busy():
+        if data.get(data.RUNNING) and not completed_steps:
+            states.set(states.ROTATED, False)
+            scheduler.spawn("step", acquisition_step())
+        elif not states.get(states.TRANSFERRED) and (
+            completed_steps or not data.get(data.RUNNING)
+        ):
+            scheduler.spawn("transfer", transfer_session())
 
     states.set(states.START, new_start)
     states.set(states.STOP, new_stop)
+    return scheduler.tick()
 
 
 if __name__ == "__main__":
     states.set(states.SESSION, utils.get_next_numeric_subdir(CAM_DEST))
 
     api_thread = threading.Thread(target=start_api, daemon=True)
-    sensor_thread = threading.Thread(target=read_sensor_data, daemon=True)
+    sensor_pollers = create_sensor_pollers()
     display_thread = threading.Thread(target=update_display, daemon=True)
     connection_thread = threading.Thread(target=connection_check, daemon=True)
     try:
         api_thread.start()
-        sensor_thread.start()
+        SensorPoller.store.start()
+        for poller in sensor_pollers:
+            poller.start()
         display_thread.start()
         connection_thread.start()
+        CameraThread.writer.start()
         side_cam.start()
         top_cam.start()
         while True:
-            main()
-            time.sleep(0.1)
+            time.sleep(main())
     except KeyboardInterrupt:
         logging.info("Exiting program.")
     finally:
         stop_event.set()
-        sensor_thread.join()
+        api_thread.join(timeout=api.SHUTDOWN_TIMEOUT + 1)
+        for poller in sensor_pollers:
+            poller.join()
+        SensorPoller.store.stop()
         display_thread.join()
         connection_thread.join()
+        CameraThread.writer.flush(timeout=10)
         side_cam.release()
         top_cam.release()
         dxl.set_torque_enable(0)
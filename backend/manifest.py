@@ -0,0 +1,185 @@
+"""Per-session index of the stored images so queries don't need to scan the directory"""
+
+import json
+import logging
+import os
+import threading
+
+import utils
+
+MANIFEST_NAME = "manifest.jsonl"
+CONTENT_TYPES = {
+    "png": "image/png",
+    "jpg": "image/jpeg",
+    "jpeg": "image/jpeg",
+    "webp": "image/webp",
+    "tif": "image/tiff",
+    "tiff": "image/tiff",
+}
+
+
+class Manifest:
+    """Append-only JSON lines file listing every image of a session, indexed in memory"""
+
+    def __init__(self, dirpath: str):
+        self.dirpath = dirpath
+        self.path = os.path.join(dirpath, MANIFEST_NAME)
+        self.lock = threading.Lock()
+        self.entries: dict[str, dict] = {}
+        self.runs: dict[str, dict[str, list]] = {}
+        self.latest: str | None = None
+        self.load()
+
+    def load(self):
+        """Read the manifest from disk, rebuilding it from the directory if it's missing"""
+        if not os.path.isfile(self.path):
+            self.rebuild()
+            return
+
+        with open(self.path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    self.index(json.loads(line))
+                except (ValueError, KeyError):
+                    logging.warning("Skipped a corrupt line in %s", self.path)
+
+    def rebuild(self):
+        """Scan the session directory once and write a fresh manifest"""
+        self.entries.clear()
+        self.runs.clear()
+        self.latest = None
+        if os.path.isdir(self.dirpath):
+            with os.scandir(self.dirpath) as files:
+                for file in files:
+                    if not file.is_file():
+                        continue
+                    entry = create_entry(file.name, file.stat().st_size)
+                    if entry is not None:
+                        self.index(entry)
+
+        os.makedirs(self.dirpath, exist_ok=True)
+        temp = self.path + ".tmp"
+        with open(temp, "w", encoding="utf-8") as file:
+            for entry in self.entries.values():
+                file.write(json.dumps(entry) + "\n")
+        os.replace(temp, self.path)
+        logging.info(
+            "Rebuilt manifest of %s with %d images.", self.dirpath, len(self.entries)
+        )
+
+    def index(self, entry: dict):
+        """Add an entry to the in memory lookups"""
+        self.entries[entry["file"]] = entry
+        labels = self.runs.setdefault(entry["timestamp"], {})
+        utils.insert_array_padded(
+            labels.setdefault(entry["label"], []), entry["step"], entry
+        )
+        if self.latest is None or entry["timestamp"] > self.latest:
+            self.latest = entry["timestamp"]
+
+    def add(self, filename: str, size: int | None = None, **extra) -> dict | None:
+        """Register a file that was just written to the session directory
+        Args:
+            filename: The name generated by utils.generate_photo_name
+            size: The size of the file in bytes. Read from disk if not given
+            extra: Additional metadata to store with the entry
+        Returns:
+            The stored entry or None if the name isn't a photo name
+        """
+        if size is None:
+            size = os.path.getsize(os.path.join(self.dirpath, filename))
+        entry = create_entry(filename, size)
+        if entry is None:
+            return None
+        entry.update(extra)
+
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as file:
+                file.write(json.dumps(entry) + "\n")
+            self.index(entry)
+        return entry
+
+    def get(self, filename: str) -> dict | None:
+        with self.lock:
+            return self.entries.get(filename)
+
+    def latest_run(self) -> dict[str, list]:
+        """Get the images of the newest run of the session
+        Returns:
+            A copy of the entries of each camera label, placed by step
+        """
+        with self.lock:
+            if self.latest is None:
+                return {}
+            return {
+                label: list(entries)
+                for label, entries in self.runs[self.latest].items()
+            }
+
+
+def create_entry(filename: str, size: int) -> dict | None:
+    """Build a manifest entry from a photo filename
+    Args:
+        filename: The name generated by utils.generate_photo_name
+        size: The size of the file in bytes
+    Returns:
+        The entry or None if the file isn't a photo
+    """
+    try:
+        label, timestamp, step, ext = utils.extract_photo_name(filename)
+    except ValueError:
+        return None
+    if ext.lower() not in CONTENT_TYPES or not step.isdigit():
+        return None
+
+    return {
+        "file": filename,
+        "label": label,
+        "step": int(step),
+        "timestamp": timestamp,
+        "size": size,
+        "content_type": CONTENT_TYPES[ext.lower()],
+    }
+
+
+manifests: dict[str, Manifest] = {}
+manifests_lock = threading.Lock()
+
+
+def get_manifest(dirpath: str) -> Manifest:
+    """Get the cached manifest of a session directory, loading it on first use"""
+    with manifests_lock:
+        if dirpath not in manifests:
+            manifests[dirpath] = Manifest(dirpath)
+        return manifests[dirpath]
+
+
+def read_entries(dirpath: str) -> dict[str, dict]:
+    """Entries of a session's manifest by filename, without rebuilding or caching it
+    Returns:
+        The entries, empty if the session has no manifest
+    """
+    with manifests_lock:
+        manifest = manifests.get(dirpath)
+    if manifest is not None:
+        with manifest.lock:
+            return dict(manifest.entries)
+
+    entries = {}
+    try:
+        with open(os.path.join(dirpath, MANIFEST_NAME), "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                    entries[entry["file"]] = entry
+                except (ValueError, KeyError, TypeError):
+                    continue
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+def forget_manifests():
+    """Drop every cached manifest, used after the session directories are deleted"""
+    with manifests_lock:
+        manifests.clear()
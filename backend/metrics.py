@@ -0,0 +1,160 @@
+"""Timing spans and counters of the chamber, exposed in the Prometheus text format"""
+
+import functools
+import inspect
+import threading
+import time
+from contextlib import contextmanager
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Metric:
+    """A metric family with a single label, each label value has its own series"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, description: str, label: str):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def header(self) -> list[str]:
+        return [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+
+    def render(self) -> list[str]:
+        raise NotImplementedError
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, description: str, label: str):
+        super().__init__(name, description, label)
+        self.values: dict[str, float] = {}
+
+    def set(self, label_value: str, value: float):
+        with self.lock:
+            self.values[label_value] = value
+
+    def render(self) -> list[str]:
+        with self.lock:
+            values = dict(self.values)
+        return self.header() + [
+            f'{self.name}{{{self.label}="{key}"}} {value}'
+            for key, value in sorted(values.items())
+        ]
+
+
+class Counter(Gauge):
+    kind = "counter"
+
+    def inc(self, label_value: str, amount: float = 1):
+        with self.lock:
+            self.values[label_value] = self.values.get(label_value, 0) + amount
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, label: str, buckets=BUCKETS):
+        super().__init__(name, description, label)
+        self.buckets = buckets
+        # Per label value: the count of every bucket, the sum and the total count
+        self.series: dict[str, tuple[list[int], list[float]]] = {}
+
+    def observe(self, label_value: str, value: float):
+        with self.lock:
+            counts, totals = self.series.setdefault(
+                label_value, ([0] * len(self.buckets), [0.0, 0])
+            )
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            totals[0] += value
+            totals[1] += 1
+
+    def render(self) -> list[str]:
+        with self.lock:
+            series = {
+                key: (list(counts), list(totals))
+                for key, (counts, totals) in self.series.items()
+            }
+        lines = self.header()
+        for key, (counts, (total, count)) in sorted(series.items()):
+            label = f'{self.label}="{key}"'
+            for bound, bucket in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {bucket}')
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {count}')
+            lines.append(f"{self.name}_sum{{{label}}} {total}")
+            lines.append(f"{self.name}_count{{{label}}} {count}")
+        return lines
+
+
+registry: list[Metric] = []
+
+stages = Histogram(
+    "chamber_stage_duration_seconds", "Time spent on each stage of a session", "stage"
+)
+camera_fps = Gauge("chamber_camera_fps", "Frames captured per second", "camera")
+camera_frames = Counter(
+    "chamber_camera_frames_total", "Frames captured since start", "camera"
+)
+camera_encode = Histogram(
+    "chamber_camera_encode_seconds", "Time to encode a stream frame", "camera"
+)
+i2c_wait = Histogram(
+    "chamber_i2c_wait_seconds", "Time waiting for the shared I2C bus", "client"
+)
+display_pages = Counter(
+    "chamber_display_pages_total", "Pages sent to the OLED display", "display"
+)
+
+
+@contextmanager
+def span(stage: str):
+    """Measure the wall time of the enclosed block into the stage histogram"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages.observe(stage, time.perf_counter() - started)
+
+
+def timed(stage: str):
+    """Decorator measuring every call of a function as a span. Generator functions,
+    like the scheduler tasks, are measured from their start until they return.
+    """
+
+    def decorator(function):
+        if inspect.isgeneratorfunction(function):
+
+            @functools.wraps(function)
+            def generator_wrapper(*args, **kwargs):
+                with span(stage):
+                    return (yield from function(*args, **kwargs))
+
+            return generator_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def render() -> str:
+    """Every registered metric in the Prometheus text format"""
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
@@ -6,8 +6,10 @@ From https://github.com/aakieu/ax12_control
 """
 
 import logging
+import time
 
-from dynamixel_sdk import *  # type: ignore # Uses Dynamixel SDK library
+from hardware import PacketHandler, PortHandler  # Dynamixel SDK or its simulation
+from scheduler import run_blocking
 
 logging.basicConfig(
     format=(
@@ -21,6 +23,8 @@ logging.basicConfig(
     handlers=[logging.StreamHandler()],
 )
 
+COMM_SUCCESS = 0
+
 # Control table ADDRess for AX-12
 # EEPROM REGISTER ADDRESSES - Permanently stored in memory once changed
 ADDR_AX_MODEL_NUMBER_L = 0
@@ -76,6 +80,20 @@ ADDR_AX_LOCK = 47
 ADDR_AX_PUNCH_L = 48
 ADDR_AX_PUNCH_H = 49
 
+# RAM registers that can be written, mirrored on the client to skip redundant writes.
+# Torque enable and the registered instruction are left out, the motor changes them on its
+# own: torque turns on with a goal and off on an alarm shutdown.
+CACHED_REGISTERS = set(range(ADDR_AX_LED, ADDR_AX_PRESENT_POSITION_L)) | {
+    ADDR_AX_LOCK,
+    ADDR_AX_PUNCH_L,
+    ADDR_AX_PUNCH_H,
+}
+VERIFY_START = ADDR_AX_TORQUE_ENABLE
+VERIFY_LENGTH = ADDR_AX_TORQUE_LIMIT_H - ADDR_AX_TORQUE_ENABLE + 1
+MOTION_LENGTH = ADDR_AX_MOVING - ADDR_AX_PRESENT_POSITION_L + 1
+ARRIVAL_TOLERANCE = 4
+ARRIVAL_POLL = 0.05
+
 
 class Ax12:
     """Class for Dynamixel AX12A motors."""
@@ -84,41 +102,130 @@ class Ax12:
     BAUDRATE = 1_000_000  # Dynamixel default baudrate
     DEVICENAME: str = "/dev/ttyUSB0"  # e.g 'COM3' windows or '/dev/ttyUSB0' for linux
     DEBUG = True
+    VERIFY = (
+        False  # Read the written RAM registers back in a single batched transaction
+    )
 
     def __init__(self, motor_id):
         """Initialize motor with id"""
         self.id = motor_id
+        self.control_table: dict[int, int] = {}
+        self.unverified: dict[int, int] = {}
 
     def __repr__(self):
         return "Ax12('{}')".format(self.id)
 
     # functions to read/write to registers
-    def set_register1(self, reg_num, reg_value):
-        dxl_comm_result, dxl_error = Ax12.packetHandler.write1ByteTxRx(
+    def is_cached(self, reg_num, reg_value, size) -> bool:
+        """Whether the mirror of the control table already holds the value"""
+        if reg_num not in CACHED_REGISTERS:
+            return False
+        if size == 1:
+            return self.control_table.get(reg_num) == reg_value
+        return (
+            self.control_table.get(reg_num) == reg_value & 0xFF
+            and self.control_table.get(reg_num + 1) == reg_value >> 8
+        )
+
+    def mirror(self, reg_num, reg_value, size, written: bool):
+        """Store a value known to be in the motor's control table"""
+        values = {reg_num: reg_value & 0xFF}
+        if size == 2:
+            values[reg_num + 1] = (reg_value >> 8) & 0xFF
+        for address, value in values.items():
+            if address not in CACHED_REGISTERS:
+                continue
+            self.control_table[address] = value
+            if written:
+                self.unverified[address] = value
+
+    def forget(self, reg_num, size):
+        """Drop mirrored values that may no longer match the motor"""
+        for address in range(reg_num, reg_num + size):
+            self.control_table.pop(address, None)
+            self.unverified.pop(address, None)
+
+    def clear_cache(self):
+        """Forget the whole mirror, e.g. when the motor may have been power cycled"""
+        self.control_table.clear()
+        self.unverified.clear()
+
+    def write_register(self, reg_num, reg_value, size) -> bool:
+        """Write a register unless the mirror says it already holds the value
+        Returns:
+            Whether a transaction was sent to the motor
+        """
+        if self.is_cached(reg_num, reg_value, size):
+            return False
+
+        write = (
+            Ax12.packetHandler.write1ByteTxRx
+            if size == 1
+            else Ax12.packetHandler.write2ByteTxRx
+        )
+        dxl_comm_result, dxl_error = write(
             Ax12.portHandler, self.id, reg_num, reg_value
         )
-        Ax12.check_error(dxl_comm_result, dxl_error)
+        if Ax12.check_error(dxl_comm_result, dxl_error):
+            self.mirror(reg_num, reg_value, size, True)
+        else:
+            self.forget(reg_num, size)
+        return True
+
+    def set_register1(self, reg_num, reg_value) -> bool:
+        return self.write_register(reg_num, reg_value, 1)
 
     def get_register1(self, reg_num):
         reg_data, dxl_comm_result, dxl_error = Ax12.packetHandler.read1ByteTxRx(
             Ax12.portHandler, self.id, reg_num
         )
-        Ax12.check_error(dxl_comm_result, dxl_error)
+        if Ax12.check_error(dxl_comm_result, dxl_error):
+            self.mirror(reg_num, reg_data, 1, False)
         return reg_data
 
-    def set_register2(self, reg_num, reg_value):
-        dxl_comm_result, dxl_error = Ax12.packetHandler.write2ByteTxRx(
-            Ax12.portHandler, self.id, reg_num, reg_value
-        )
-        Ax12.check_error(dxl_comm_result, dxl_error)
+    def set_register2(self, reg_num, reg_value) -> bool:
+        return self.write_register(reg_num, reg_value, 2)
 
     def get_register2(self, reg_num_low):
         reg_data, dxl_comm_result, dxl_error = Ax12.packetHandler.read2ByteTxRx(
             Ax12.portHandler, self.id, reg_num_low
         )
-        Ax12.check_error(dxl_comm_result, dxl_error)
+        if Ax12.check_error(dxl_comm_result, dxl_error):
+            self.mirror(reg_num_low, reg_data, 2, False)
         return reg_data
 
+    def verify(self) -> bool:
+        """Read back every register written since the last verification in one transaction
+        Returns:
+            Whether the motor holds the values that were written
+        """
+        if not self.unverified:
+            return True
+
+        start = min(min(self.unverified), VERIFY_START)
+        length = max(max(self.unverified) - start + 1, VERIFY_LENGTH)
+        reg_data, dxl_comm_result, dxl_error = Ax12.packetHandler.readTxRx(
+            Ax12.portHandler, self.id, start, length
+        )
+        if not Ax12.check_error(dxl_comm_result, dxl_error):
+            return False
+
+        matches = True
+        for address, expected in self.unverified.items():
+            actual = reg_data[address - start]
+            if actual != expected:
+                logging.warning(
+                    "Register %d of dxl ID: %d holds %d, expected %d",
+                    address,
+                    self.id,
+                    actual,
+                    expected,
+                )
+                matches = False
+            self.control_table[address] = actual
+        self.unverified.clear()
+        return matches
+
     # functions for Read-Only registers
     def get_model_number(self):
         return self.get_register2(ADDR_AX_MODEL_NUMBER_L)
@@ -151,6 +258,62 @@ class Ax12:
         """Returns 1 if motor is moving , 0 if not moving"""
         return self.get_register1(ADDR_AX_MOVING)
 
+    def get_motion(self) -> tuple[int, int] | None:
+        """Read the present position and the moving flag in a single transaction
+        Returns:
+            The present position and moving flag, None if the read failed
+        """
+        reg_data, dxl_comm_result, dxl_error = Ax12.packetHandler.readTxRx(
+            Ax12.portHandler, self.id, ADDR_AX_PRESENT_POSITION_L, MOTION_LENGTH
+        )
+        if not Ax12.check_error(dxl_comm_result, dxl_error):
+            return None
+        position = reg_data[0] | (reg_data[1] << 8)
+        return position, reg_data[ADDR_AX_MOVING - ADDR_AX_PRESENT_POSITION_L]
+
+    def has_arrived(self, goal_pos, tolerance=ARRIVAL_TOLERANCE) -> bool:
+        """Whether the motor stopped moving within tolerance of the goal position"""
+        motion = self.get_motion()
+        if motion is None:
+            return False
+        position, moving = motion
+        return not moving and abs(position - goal_pos) <= tolerance
+
+    def arrival_task(
+        self, goal_pos, tolerance=ARRIVAL_TOLERANCE, timeout=10.0, poll=ARRIVAL_POLL
+    ):
+        """Generator polling the motor until it arrives, yielding the seconds to wait
+        between polls so it can run on a cooperative scheduler.
+        Returns:
+            Whether the motor arrived before the timeout
+        """
+        deadline = time.monotonic() + timeout
+        while not self.has_arrived(goal_pos, tolerance):
+            if time.monotonic() >= deadline:
+                logging.warning(
+                    "dxl ID: %d didn't reach %d within %.1f s",
+                    self.id,
+                    goal_pos,
+                    timeout,
+                )
+                return False
+            yield poll
+        return True
+
+    def wait_until_arrived(
+        self, goal_pos, tolerance=ARRIVAL_TOLERANCE, timeout=10.0, poll=ARRIVAL_POLL
+    ) -> bool:
+        """Block until the motor is within tolerance of the goal position and stopped
+        Args:
+            goal_pos: The goal position in bytes [0-1023]
+            tolerance: The allowed distance to the goal in bytes
+            timeout: Maximum seconds to wait
+            poll: Seconds between reads of the motor
+        Returns:
+            Whether the motor arrived before the timeout
+        """
+        return run_blocking(self.arrival_task(goal_pos, tolerance, timeout, poll))
+
     # functions for EEPROM Read/Write registers - stored in memory once changed
     def get_id(self):
         return self.get_register1(ADDR_AX_ID)
@@ -166,7 +329,7 @@ class Ax12:
         self.set_register1(ADDR_AX_BAUD_RATE, baudrate)
 
         if self.DEBUG:
-            self.print_status("Baudrate of ", self.id, self.get_baudrate())
+            self.print_status("Baudrate of ", self.id, baudrate)
 
     def get_return_delay_time(self):
         return self.get_register1(ADDR_AX_RETURN_DELAY_TIME)
@@ -181,7 +344,7 @@ class Ax12:
         """Sets the lower limit of motor angle [512-0]"""
         self.set_register2(ADDR_AX_CW_ANGLE_LIMIT_L, angle_limit)
         if self.DEBUG:
-            self.print_status("cw angle limit of ", self.id, self.get_cw_angle_limit())
+            self.print_status("cw angle limit of ", self.id, angle_limit)
 
     def get_ccw_angle_limit(self):
         return self.get_register2(ADDR_AX_CCW_ANGLE_LIMIT_L)
@@ -190,9 +353,7 @@ class Ax12:
         """Sets the upper limit of motor angle [512-1023]"""
         self.set_register2(ADDR_AX_CCW_ANGLE_LIMIT_L, angle_limit)
         if self.DEBUG:
-            self.print_status(
-                "ccw angle limit of ", self.id, self.get_ccw_angle_limit()
-            )
+            self.print_status("ccw angle limit of ", self.id, angle_limit)
 
     def get_min_voltage_limit(self):
         return self.get_register1(ADDR_AX_MIN_LIMIT_VOLTAGE)
@@ -236,10 +397,10 @@ class Ax12:
 
     def set_torque_enable(self, torque_bool):
         """set torque on/off"""
-        self.set_register1(ADDR_AX_TORQUE_ENABLE, torque_bool)
+        written = self.set_register1(ADDR_AX_TORQUE_ENABLE, torque_bool)
 
-        if self.DEBUG:
-            self.print_status("Torque enable ", self.id, self.get_torque_enable())
+        if self.DEBUG and written:
+            self.print_status("Torque enable ", self.id, torque_bool)
 
     def set_led(self, led_bool):
         """Sets Motor Led; 0 => OFF  1 => ON ."""
@@ -274,10 +435,10 @@ class Ax12:
 
     def set_goal_position(self, goal_pos):
         """Write goal position."""
-        self.set_register2(ADDR_AX_GOAL_POSITION_L, goal_pos)
+        written = self.set_register2(ADDR_AX_GOAL_POSITION_L, goal_pos)
 
-        if self.DEBUG:
-            self.print_status("Position of ", self.id, self.get_goal_position())
+        if self.DEBUG and written:
+            self.print_status("Position of ", self.id, goal_pos)
 
     def get_moving_speed(self):
         """Returns moving speed to goal position [0-1023]."""
@@ -285,10 +446,10 @@ class Ax12:
 
     def set_moving_speed(self, moving_speed):
         """Set the moving speed to goal position [0-1023]."""
-        self.set_register2(ADDR_AX_GOAL_SPEED_L, moving_speed)
+        written = self.set_register2(ADDR_AX_GOAL_SPEED_L, moving_speed)
 
-        if self.DEBUG:
-            self.print_status("Moving speed of ", self.id, self.get_moving_speed())
+        if self.DEBUG and written:
+            self.print_status("Moving speed of ", self.id, moving_speed)
 
     def get_torque_limit(self):
         return self.get_register2(ADDR_AX_TORQUE_LIMIT_L)
@@ -355,11 +516,14 @@ class Ax12:
         logging.info("Successfully closed port")
 
     @staticmethod
-    def check_error(comm_result, dxl_err):
+    def check_error(comm_result, dxl_err) -> bool:
         if comm_result != COMM_SUCCESS:
             logging.warning("%s" % Ax12.packetHandler.getTxRxResult(comm_result))
-        elif dxl_err != 0:
+            return False
+        if dxl_err != 0:
             logging.error("%s" % Ax12.packetHandler.getRxPacketError(dxl_err))
+            return False
+        return True
 
     @staticmethod
     def raw2deg(delta_raw):
@@ -5,40 +5,161 @@ import threading
 import time
 
 import cv2
-from cv2.typing import MatLike
 import numpy as np
+from cv2.typing import MatLike
+import metrics
+from events import publish_photo
 import utils
+from hardware import VideoCapture
 from data import states
+from manifest import get_manifest
+from modules.framebuffer import Frame, FrameRing, is_jpeg
+from modules.stream import FrameBroadcaster
+from modules.writer import DEFAULT_ENCODER, Encoder, ImageWriter
 import os
 
 CAMERA_WIDTH = 320
 CAMERA_HEIGHT = 240
 CAMERA_FPS = 10
+# Seconds over which the measured frame rate is averaged
+FPS_WINDOW = 5
+# Keep the JPEG sent by the camera and stream it as is, stills are decoded on demand
+MJPEG_PASSTHROUGH = True
+# Frames dropped once a still is due, the one being exposed may predate the request
+STILL_SKIP_FRAMES = 1
+# Seconds a still may take past the time it was due before the preview is used instead
+STILL_TIMEOUT = 5
+STILL_READ_ATTEMPTS = 10
+# Bursts are scored on a copy this many times smaller, JPEGs are decoded straight at it
+SHARPNESS_REDUCTION = 4
+
+
+def sharpness(frame: np.ndarray) -> float:
+    """Variance of the Laplacian of a downscaled grayscale copy, higher is sharper
+    Args:
+        frame: The BGR pixels or the JPEG sent by the camera
+    """
+    if is_jpeg(frame):
+        gray = cv2.imdecode(  # pylint: disable=no-member
+            frame, cv2.IMREAD_REDUCED_GRAYSCALE_4  # pylint: disable=no-member
+        )
+    else:
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)  # pylint: disable=no-member
+        gray = cv2.resize(  # pylint: disable=no-member
+            gray,
+            None,
+            fx=1 / SHARPNESS_REDUCTION,
+            fy=1 / SHARPNESS_REDUCTION,
+            interpolation=cv2.INTER_AREA,  # pylint: disable=no-member
+        )
+    if gray is None:
+        return 0.0
+    return float(cv2.Laplacian(gray, cv2.CV_32F).var())  # pylint: disable=no-member
+
 
+class StillRequest:
+    """A full resolution still requested to the capture thread. With a burst of more
+    than one frame the sharpest one is kept.
+    """
 
-def create_blank_jpeg():
-    """Create a 1x1 black pixel (uint8, BGR)"""
-    img = np.zeros((1, 1, 3), dtype=np.uint8)
+    def __init__(
+        self, not_before: float, count: int = 1, deadline: float | None = None
+    ):
+        """
+        Args:
+            not_before: Monotonic time of the first frame the still may be taken from
+            count: Number of consecutive frames to choose from
+            deadline: Monotonic time the burst is cut short at, if it has a frame
+        """
+        self.not_before = not_before
+        self.count = count
+        self.deadline = deadline
+        self.skipped = 0
+        self.taken = 0
+        self.scores: list[float] = []
+        self.best: np.ndarray | None = None
+        self.frame: MatLike | None = None
+        self.event = threading.Event()
+
+    def done(self) -> bool:
+        return self.event.is_set()
+
+    def add(self, frame: np.ndarray):
+        """Take a frame of the burst, kept if it's the sharpest so far"""
+        self.taken += 1
+        if self.count == 1:
+            self.best = frame
+            return
+        score = sharpness(frame)
+        if not self.scores or score > max(self.scores):
+            self.best = frame
+        self.scores.append(score)
+
+    def complete(self, now: float) -> bool:
+        if self.best is None:
+            return False
+        return self.taken >= self.count or (
+            self.deadline is not None and now >= self.deadline
+        )
 
-    success, buffer = cv2.imencode(".jpg", img)
-    if not success:
-        return b""  # fallback
-    return buffer.tobytes()
+    def resolve(self):
+        """Decode the chosen frame and hand it to the waiting task"""
+        frame = self.best
+        if frame is not None and is_jpeg(frame):
+            frame = cv2.imdecode(frame, cv2.IMREAD_COLOR)  # pylint: disable=no-member
+        self.frame = frame
+        self.event.set()
+
+    def metadata(self) -> dict:
+        """The sharpness of the kept frame and of the whole burst, for the manifest"""
+        if not self.scores:
+            return {}
+        return {
+            "sharpness": round(max(self.scores), 2),
+            "burst_scores": [round(score, 2) for score in self.scores],
+        }
 
 
 class CameraThread(threading.Thread):
     """Main class representing a Camera accessible via cv2"""
+
     cameras: list["CameraThread"] = []
+    writer = ImageWriter()
+    # Format of the stills by camera label, DEFAULT_ENCODER for the rest
+    encoders: dict[str, Encoder] = {}
 
-    def __init__(self, prefix: str, device_index, stop_event, width, height):
+    def __init__(
+        self,
+        prefix: str,
+        device_index,
+        stop_event,
+        width,
+        height,
+        preview_width=CAMERA_WIDTH,
+        preview_height=CAMERA_HEIGHT,
+    ):
+        """
+        Args:
+            prefix: The label of the camera in the photo names
+            device_index: The index of the video device
+            stop_event: Stops the thread once set
+            width: Width of the stills
+            height: Height of the stills
+            preview_width: Width of the frames streamed meanwhile
+            preview_height: Height of the frames streamed meanwhile
+        """
         super().__init__(daemon=True)
         self.prefix = prefix
         self.device_index = device_index
         self.fps = CAMERA_FPS
-        self.width = width
-        self.height = height
+        self.width = preview_width
+        self.height = preview_height
+        self.still_size = (width, height)
+        self.still_lock = threading.Lock()
+        self.still_requests: list[StillRequest] = []
+        self.restoring: float | None = None
 
-        self.capture = cv2.VideoCapture(device_index)  # pylint: disable=no-member
+        self.capture = VideoCapture(device_index)
         self.capture.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*"MJPG"))
         self.capture.set(
             cv2.CAP_PROP_FRAME_WIDTH, self.width  # pylint: disable=no-member
@@ -47,17 +168,25 @@ class CameraThread(threading.Thread):
             cv2.CAP_PROP_FRAME_HEIGHT, self.height  # pylint: disable=no-member
         )
         self.capture.set(cv2.CAP_PROP_FPS, self.fps)  # pylint: disable=no-member
+        if MJPEG_PASSTHROUGH:
+            self.capture.set(cv2.CAP_PROP_CONVERT_RGB, 0)  # pylint: disable=no-member
 
-        self.lock = threading.Lock()
         self.stop_event = stop_event
-        self.frame = None
+        self.ring = FrameRing()
+        self.broadcaster = FrameBroadcaster(self, stop_event)
         CameraThread.cameras.append(self)
 
     def run(self):
         """The main thread of the instance, updates the latest frame"""
         warned = False
+        compressed = None
+        window_start, window_frames = time.monotonic(), 0
+        self.broadcaster.start()
         while not self.stop_event.is_set():
-            status, frame = self.capture.read()
+            if self.still_requests:
+                self.capture_stills()
+                continue
+            status, frame = self.capture.read(self.ring.next_buffer())
             if not status or frame is None or frame.size == 0:
                 if not warned:
                     logging.warning(
@@ -66,63 +195,185 @@ class CameraThread(threading.Thread):
                     warned = True
                 time.sleep(0.1)
                 continue
-            with self.lock:
-                self.frame = frame.copy()
+            if compressed is None:
+                compressed = is_jpeg(frame)
+                logging.info(
+                    "Camera %d delivers %s frames.",
+                    self.device_index,
+                    "JPEG" if compressed else "decoded",
+                )
+            if self.restoring is not None:
+                metrics.stages.observe(
+                    f"{self.prefix}_preview_switch",
+                    time.perf_counter() - self.restoring,
+                )
+                self.restoring = None
+            self.ring.commit(frame, time.time(), compressed)
+            metrics.camera_frames.inc(self.prefix)
+            window_frames += 1
+            elapsed = time.monotonic() - window_start
+            if elapsed >= FPS_WINDOW:
+                metrics.camera_fps.set(self.prefix, window_frames / elapsed)
+                window_start, window_frames = time.monotonic(), 0
             time.sleep(1.0 / self.fps)
 
+    @metrics.timed("frame_grab")
     def get_frame(self):
-        """Create a copy of the latest frame"""
-        with self.lock:
-            if self.frame is None:
-                return None
-            return self.frame.copy()
+        """Create a copy of the latest frame, safe to keep while it's being saved. JPEG
+        frames are only decoded here, when a still is actually needed.
+        """
+        frame = self.ring.latest()
+        if frame is None:
+            return None
+        if frame.compressed:
+            return frame.decode()
+        return frame.image.copy()
+
+    def set_resolution(self, width: int, height: int):
+        """Change the capture format. OpenCV's V4L2 backend restarts the stream once,
+        when both sizes have been set.
+        """
+        self.capture.set(cv2.CAP_PROP_FRAME_WIDTH, width)  # pylint: disable=no-member
+        self.capture.set(cv2.CAP_PROP_FRAME_HEIGHT, height)  # pylint: disable=no-member
+
+    def request_still(
+        self, not_before: float, count: int = 1, deadline: float | None = None
+    ) -> StillRequest:
+        """Ask the capture thread for a still at full resolution. The camera switches
+        right away, so the format change overlaps whatever the caller waits for.
+        Args:
+            not_before: Monotonic time of the first frame the still may be taken from
+            count: Number of consecutive frames the sharpest one is chosen from
+            deadline: Monotonic time the burst ends at even if it's shorter than count
+        """
+        request = StillRequest(not_before, count, deadline)
+        with self.still_lock:
+            self.still_requests.append(request)
+        return request
+
+    def capture_stills(self):
+        """Switch to the still resolution, serve every pending request and switch back
+        to the preview. The preview stalls meanwhile.
+        """
+        switching = self.still_size != (self.width, self.height)
+        started = time.perf_counter()
+        if switching:
+            self.set_resolution(*self.still_size)
+        failures = 0
+        while self.still_requests and not self.stop_event.is_set():
+            status, frame = self.capture.read()
+            if not status or frame is None or frame.size == 0:
+                failures += 1
+                if failures < STILL_READ_ATTEMPTS:
+                    continue
+                logging.warning("Camera %d failed taking a still.", self.device_index)
+                frame = None
+            else:
+                # Only consecutive failures give up on the pending requests
+                failures = 0
+                if started is not None:
+                    metrics.stages.observe(
+                        f"{self.prefix}_still_switch", time.perf_counter() - started
+                    )
+                    started = None
+
+            now = time.monotonic()
+            with self.still_lock:
+                pending = list(self.still_requests)
+            for request in pending:
+                if frame is not None and now < request.not_before:
+                    continue
+                if frame is not None and request.skipped < STILL_SKIP_FRAMES:
+                    request.skipped += 1
+                    continue
+                if frame is not None:
+                    request.add(frame)
+                    if not request.complete(now):
+                        continue
+                request.resolve()
+                with self.still_lock:
+                    self.still_requests.remove(request)
+
+        if switching:
+            self.restoring = time.perf_counter()
+            self.set_resolution(self.width, self.height)
+
+    def still_task(self, not_before: float, count: int = 1, budget: float = 0):
+        """Scheduler task taking a full resolution still, falls back to the latest
+        preview frame if the camera fails to switch
+        Args:
+            not_before: Monotonic time of the first frame the still may be taken from
+            count: Number of consecutive frames the sharpest one is chosen from
+            budget: Seconds the burst may last once due
+        Returns:
+            The still and its metadata, to be passed to save_image
+        """
+        request = self.request_still(not_before, count, not_before + budget)
+        timeout = not_before + budget + STILL_TIMEOUT
+        yield lambda: request.done() or time.monotonic() > timeout
+        if request.frame is None:
+            logging.warning(
+                "Camera %d took no still, saving the preview.", self.device_index
+            )
+            return self.get_frame(), {}
+        return request.frame, request.metadata()
+
+    def latest(self) -> Frame | None:
+        """Get a read-only view of the latest frame without copying it"""
+        return self.ring.latest()
+
+    def wait_frame(self, seq: int, timeout: float) -> Frame | None:
+        """Get a read-only view of the first frame newer than seq, blocking until it arrives
+        Args:
+            seq: The sequence number of the last frame seen by the caller
+            timeout: Maximum seconds to wait
+        """
+        return self.ring.wait_newer(seq, timeout)
 
     def release(self):
         """Release the physical camera"""
         self.capture.release()
 
-    def save_image(self, dest: str, frame: MatLike, timestamp: float, step=0):
-        """Save the RGB image to the specified directory with a timestamp and step number.
+    @metrics.timed("save_image")
+    def save_image(
+        self,
+        dest: str,
+        frame: MatLike,
+        timestamp: float,
+        step=0,
+        metadata: dict | None = None,
+    ):
+        """Queue the RGB image to be saved in the background with a timestamp and step number.
+        Blocks only while the writer queue is full. Use CameraThread.writer.flush() to wait
+        for the file to be on disk.
         Args:
             prefix: The label of the image to identify the camera
-            frame: The image frame to save.
+            frame: The image frame to save. Must not be modified afterwards
             timestamp: The timestamp to use for the filename.
             step: The step number for the filename. Defaults to 0.
+            metadata: Stored with the entry of the image in the session manifest
         """
-        filename = utils.generate_photo_name(self.prefix, timestamp, step)
-        dirpath = utils.get_session_dirpath(dest, states.get(states.SESSION))
-        cv2.imwrite(os.path.join(dirpath, filename), frame)  # pylint: disable=no-member
+        encoder = CameraThread.encoders.get(self.prefix, DEFAULT_ENCODER)
+        filename = utils.generate_photo_name(self.prefix, timestamp, step, encoder.ext)
+        session = states.get(states.SESSION)
+        dirpath = utils.get_session_dirpath(dest, session)
+        manifest = get_manifest(dirpath)
+        CameraThread.writer.submit(
+            os.path.join(dirpath, filename),
+            frame,
+            lambda crc: publish_photo(
+                session, manifest.add(filename, crc32=crc, **(metadata or {}))
+            ),
+            encoder,
+        )
 
-    def generate_frames(self):
-        """Constantly triggers the camera to get the latest frames and formats it for streaming.
+    def generate_frames(self, width=None, quality=None, fps=None):
+        """Subscribes to the camera broadcast, a tier's clients share the encoded frames.
         Args:
-            camera_thread: The camera object configured to manage an RGB camera
+            width: Width of the frames in pixels, None for the camera resolution
+            quality: JPEG quality, None for the default
+            fps: Maximum frames per second, None for the camera rate
         Returns:
             The HTTP streaming formatted frame
         """
-        blank = (
-            b"--frame\r\n"
-            b"Content-Type: image/jpeg\r\n\r\n" + create_blank_jpeg() + b"\r\n"
-        )
-        while not self.stop_event.is_set():
-            frame = self.get_frame()
-            if frame is None:
-                yield blank
-                time.sleep(1.0 / self.fps)
-                continue
-
-            try:
-                success, buffer = cv2.imencode(".jpg", frame)  # pylint: disable=no-member
-                frame_bytes = buffer.tobytes()
-            except:
-                logging.error(
-                    "Camera %d failed during image encoding.", self.device_index
-                )
-                yield blank
-                time.sleep(1.0 / self.fps)
-                continue
-
-            yield (
-                b"--frame\r\n" b"Content-Type: image/jpeg\r\n\r\n" + frame_bytes + b"\r\n"
-            )
-            time.sleep(1.0 / self.fps)
\ No newline at end of file
+        return self.broadcaster.stream(width, quality, fps)
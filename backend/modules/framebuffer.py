@@ -0,0 +1,117 @@
+"""Preallocated ring of camera frames shared between the capture thread and its readers"""
+
+import threading
+from typing import NamedTuple
+
+import cv2
+import numpy as np
+
+RING_SIZE = 4
+REDUCED_DECODE = {
+    2: cv2.IMREAD_REDUCED_COLOR_2,  # pylint: disable=no-member
+    4: cv2.IMREAD_REDUCED_COLOR_4,  # pylint: disable=no-member
+    8: cv2.IMREAD_REDUCED_COLOR_8,  # pylint: disable=no-member
+}
+
+
+class Frame(NamedTuple):
+    """A captured frame tagged with its sequence number and capture time"""
+
+    seq: int
+    timestamp: float
+    image: np.ndarray
+    # The image holds the JPEG bytes sent by the camera instead of the decoded pixels
+    compressed: bool = False
+
+    def decode(self, reduction: int = 1) -> np.ndarray | None:
+        """Get the BGR pixels of the frame, decoding them if the frame is compressed
+        Args:
+            reduction: 1, 2, 4 or 8. Compressed frames are decoded at that fraction of
+                their size, which is much cheaper than decoding and resizing
+        Returns:
+            A new array for compressed frames, the read-only view otherwise. None if the
+            JPEG is corrupt
+        """
+        if not self.compressed:
+            return self.image
+        flags = REDUCED_DECODE.get(reduction, cv2.IMREAD_COLOR)
+        return cv2.imdecode(self.image, flags)  # pylint: disable=no-member
+
+
+def is_jpeg(image: np.ndarray) -> bool:
+    """Whether a captured buffer holds a JPEG instead of decoded pixels"""
+    return (
+        image.dtype == np.uint8
+        and image.ndim <= 2
+        and image.size > 2
+        and image.flat[0] == 0xFF
+        and image.flat[1] == 0xD8
+    )
+
+
+class FrameRing:
+    """Fixed set of frame buffers written in place by a single capture thread.
+
+    Readers get read-only views of the slots instead of copies. A view stays valid until
+    the writer wraps around the ring, so anything kept longer than RING_SIZE - 1 frames
+    (e.g. a still that is going to be saved) must be copied by the reader.
+    """
+
+    def __init__(self, size: int = RING_SIZE):
+        self.size = size
+        self.slots: list[np.ndarray | None] = [None] * size
+        self.timestamps = [0.0] * size
+        self.compressed = [False] * size
+        self.seq = 0
+        self.cond = threading.Condition()
+
+    def next_buffer(self) -> np.ndarray | None:
+        """Get the buffer the next frame should be written into. Only the writer calls this.
+        Returns:
+            The oldest slot of the ring or None if it has not been allocated yet
+        """
+        return self.slots[(self.seq + 1) % self.size]
+
+    def commit(self, image: np.ndarray, timestamp: float, compressed=False) -> int:
+        """Publish the frame written into the buffer returned by next_buffer
+        Args:
+            image: The written frame. Adopted as the slot if the capture had to reallocate
+            timestamp: The unix time in which the frame was captured
+            compressed: The frame holds the JPEG bytes sent by the camera
+        Returns:
+            The sequence number given to the frame
+        """
+        index = (self.seq + 1) % self.size
+        self.slots[index] = image
+        self.timestamps[index] = timestamp
+        self.compressed[index] = compressed
+        with self.cond:
+            self.seq += 1
+            self.cond.notify_all()
+            return self.seq
+
+    def _frame(self, seq: int) -> Frame:
+        index = seq % self.size
+        view = self.slots[index].view()  # type: ignore[union-attr]
+        view.flags.writeable = False
+        return Frame(seq, self.timestamps[index], view, self.compressed[index])
+
+    def latest(self) -> Frame | None:
+        """Get a read-only view of the newest frame, None if nothing was captured yet"""
+        with self.cond:
+            if self.seq == 0:
+                return None
+            return self._frame(self.seq)
+
+    def wait_newer(self, seq: int, timeout: float) -> Frame | None:
+        """Block until a frame newer than seq is available
+        Args:
+            seq: The sequence number of the last frame the reader has seen
+            timeout: Maximum seconds to wait
+        Returns:
+            A read-only view of the newest frame or None if none arrived in time
+        """
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.seq > seq, timeout):
+                return None
+            return self._frame(self.seq)
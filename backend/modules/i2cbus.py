@@ -0,0 +1,64 @@
+"""Single arbiter of the I2C bus shared by the light sensors and the OLED display"""
+
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable
+
+import metrics
+from data import data
+
+SENSOR = 0
+DISPLAY = 1
+
+
+class BusScheduler:
+    """Grants the bus to one transaction at a time, lowest priority value first and in
+    arrival order within a priority. While a session runs the display waits behind any
+    pending sensor read; otherwise every client is served in arrival order.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.waiting: list[tuple[int, int]] = []
+        self.tickets = itertools.count()
+        self.owner: tuple[int, int] | None = None
+
+    def effective_priority(self, priority: int) -> int:
+        return priority if data.get(data.RUNNING) else SENSOR
+
+    @contextmanager
+    def transaction(self, priority: int):
+        """Hold the bus for the enclosed block
+        Args:
+            priority: SENSOR or DISPLAY
+        """
+        ticket = (self.effective_priority(priority), next(self.tickets))
+        requested = time.perf_counter()
+        with self.condition:
+            heapq.heappush(self.waiting, ticket)
+            self.condition.wait_for(
+                lambda: self.owner is None and self.waiting[0] == ticket
+            )
+            heapq.heappop(self.waiting)
+            self.owner = ticket
+        metrics.i2c_wait.observe(
+            "sensor" if priority == SENSOR else "display",
+            time.perf_counter() - requested,
+        )
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.owner = None
+                self.condition.notify_all()
+
+    def call(self, priority: int, function: Callable):
+        """Run a function holding the bus and return its result"""
+        with self.transaction(priority):
+            return function()
+
+
+i2c_bus = BusScheduler()
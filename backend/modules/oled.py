@@ -0,0 +1,56 @@
+"""SH1106 renderer that only sends the pages of the framebuffer that changed"""
+
+import numpy as np
+from PIL import Image
+
+import metrics
+from modules.i2cbus import DISPLAY, i2c_bus
+
+PAGE_HEIGHT = 8
+SET_PAGE_ADDRESS = 0xB0
+# The SH1106 has 132 columns of RAM, the 128 visible ones start at column 2
+COLUMN_LOW = 0x02
+COLUMN_HIGH = 0x10
+
+
+class PagedDisplay:
+    """Keeps a copy of what the display shows and writes each dirty page in its own bus
+    transaction, so a sensor read never waits for more than a page
+    """
+
+    def __init__(self, device, name: str = "sh1106"):
+        self.device = device
+        self.name = name
+        self.width = device.width
+        self.height = device.height
+        self.pages: list[bytes | None] = [None] * (self.height // PAGE_HEIGHT)
+
+    def encode(self, image: Image.Image) -> list[bytes]:
+        """Split a 1 bit image in the SH1106 page layout, a byte per column of 8 rows
+        with the top row in the least significant bit
+        """
+        pixels = np.asarray(self.device.preprocess(image).convert("1"), dtype=bool)
+        pages = pixels.reshape(len(self.pages), PAGE_HEIGHT, self.width)
+        packed = np.packbits(pages, axis=1, bitorder="little")
+        return [page.tobytes() for page in packed[:, 0, :]]
+
+    def display(self, image: Image.Image) -> int:
+        """Send the pages that differ from what's on screen
+        Returns:
+            The number of pages sent
+        """
+        sent = 0
+        for index, page in enumerate(self.encode(image)):
+            if page == self.pages[index]:
+                continue
+            with i2c_bus.transaction(DISPLAY):
+                self.device.command(SET_PAGE_ADDRESS + index, COLUMN_LOW, COLUMN_HIGH)
+                self.device.data(list(page))
+            self.pages[index] = page
+            sent += 1
+        metrics.display_pages.inc(self.name, sent)
+        return sent
+
+    def invalidate(self):
+        """Forget what's on screen, the next image is sent whole"""
+        self.pages = [None] * len(self.pages)
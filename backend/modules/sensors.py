@@ -0,0 +1,180 @@
+"""Sensors sampled on their own threads and rates, with a history of their readings"""
+
+import logging
+import threading
+import time
+from typing import Callable
+
+import numpy as np
+
+import metrics
+from data import data, states
+from sensorstore import SensorStore
+
+HISTORY_SIZE = 3600
+
+
+class SensorHistory:
+    """Fixed-size ring buffer of timestamped readings stored in NumPy arrays"""
+
+    def __init__(self, fields: list[str], capacity: int = HISTORY_SIZE):
+        self.fields = fields
+        self.lock = threading.Lock()
+        self.timestamps = np.zeros(capacity, dtype=np.float64)
+        self.values = np.zeros((capacity, len(fields)), dtype=np.float64)
+        self.head = 0
+        self.count = 0
+
+    def append(self, timestamp: float, values: dict):
+        with self.lock:
+            self.timestamps[self.head] = timestamp
+            self.values[self.head] = [values[field] for field in self.fields]
+            self.head = (self.head + 1) % len(self.timestamps)
+            self.count = min(self.count + 1, len(self.timestamps))
+
+    def window(
+        self, start: float | None = None, end: float | None = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Copy the readings taken between start and end, oldest first"""
+        with self.lock:
+            order = (np.arange(self.count) + self.head - self.count) % len(
+                self.timestamps
+            )
+            timestamps = self.timestamps[order]
+            values = self.values[order]
+        mask = np.ones(len(timestamps), dtype=bool)
+        if start is not None:
+            mask &= timestamps >= start
+        if end is not None:
+            mask &= timestamps <= end
+        return timestamps[mask], values[mask]
+
+    def downsample(
+        self, points: int, start: float | None = None, end: float | None = None
+    ) -> dict:
+        """Average the readings into at most the given number of equally long buckets
+        Args:
+            points: Maximum number of readings to return
+            start: Unix time of the oldest reading to include
+            end: Unix time of the newest reading to include
+        Returns:
+            The timestamps and the values of every field, ready to be serialized
+        """
+        timestamps, values = self.window(start, end)
+        if len(timestamps) > points > 0:
+            edges = np.linspace(timestamps[0], timestamps[-1], points + 1)
+            buckets = np.clip(
+                np.searchsorted(edges, timestamps, "right") - 1, 0, points - 1
+            )
+            counts = np.bincount(buckets, minlength=points)
+            filled = counts > 0
+            timestamps = (
+                np.bincount(buckets, timestamps, minlength=points)[filled]
+                / counts[filled]
+            )
+            values = np.stack(
+                [
+                    np.bincount(buckets, values[:, i], minlength=points)[filled]
+                    / counts[filled]
+                    for i in range(len(self.fields))
+                ],
+                axis=1,
+            ).reshape(-1, len(self.fields))
+        return {
+            "timestamps": timestamps.round(3).tolist(),
+            "values": {
+                field: values[:, i].round(3).tolist()
+                for i, field in enumerate(self.fields)
+            },
+        }
+
+
+class SensorPoller(threading.Thread):
+    """Samples a single sensor at its own rate, faster while a session is running"""
+
+    pollers: dict[str, "SensorPoller"] = {}
+    store: SensorStore | None = None
+    rate_changed = threading.Condition()
+
+    def __init__(
+        self,
+        name: str,
+        fields: list[str],
+        read: Callable[[], dict],
+        interval: float,
+        active_interval: float,
+        stop_event: threading.Event,
+        fallback: dict | None = None,
+    ):
+        """
+        Args:
+            name: Identifies the sensor in the logs, metrics and history
+            fields: The data keys the sensor updates
+            read: Returns the new value of every one of its fields
+            interval: Seconds between readings while idle
+            active_interval: Seconds between readings during a session
+            stop_event: Stops the thread once set
+            fallback: The values published while the sensor fails
+        """
+        super().__init__(name=f"Sensor-{name}", daemon=True)
+        self.sensor = name
+        self.read = read
+        self.interval = interval
+        self.active_interval = active_interval
+        self.stop_event = stop_event
+        self.fallback = fallback
+        self.history = SensorHistory(fields)
+        self.failures = 0
+        SensorPoller.pollers[name] = self
+
+    def current_interval(self) -> float:
+        return self.active_interval if data.get(data.RUNNING) else self.interval
+
+    def poll(self):
+        """Take a single reading and publish it"""
+        try:
+            with metrics.span(f"{self.sensor}_read"):
+                values = self.read()
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            if self.failures == 0:
+                logging.warning("Sensor %s failed reading. %s", self.sensor, e)
+            self.failures += 1
+            if self.fallback is not None:
+                data.update_many(self.fallback)
+            return
+
+        if self.failures:
+            logging.info(
+                "Sensor %s recovered after %d failures.", self.sensor, self.failures
+            )
+            self.failures = 0
+        timestamp = time.time()
+        self.history.append(timestamp, values)
+        data.update_many(values)
+        if SensorPoller.store is not None:
+            running = data.get(data.RUNNING)
+            session = states.get(states.SESSION) if running else None
+            SensorPoller.store.record(self.sensor, timestamp, session, values)
+
+    def run(self):
+        while not self.stop_event.is_set():
+            started = time.monotonic()
+            self.poll()
+            remaining = self.current_interval() - (time.monotonic() - started)
+            # Woken up early when a session starts so the faster rate applies at once
+            if remaining > 0:
+                with SensorPoller.rate_changed:
+                    SensorPoller.rate_changed.wait(remaining)
+        logging.info("Sensor %s stopped.", self.sensor)
+
+
+def wake_pollers(changes: dict, version: int):
+    """Change listener of the data manager, reschedules the pollers when a session starts
+    or stops so they switch to their other rate
+    """
+    if data.RUNNING in changes:
+        with SensorPoller.rate_changed:
+            SensorPoller.rate_changed.notify_all()
+
+
+data.on_change(wake_pollers)
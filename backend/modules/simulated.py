@@ -0,0 +1,470 @@
+"""Simulated stand-ins for the chamber hardware, used to run whole sessions off-device.
+
+Every class mimics the small part of the library API the backend uses: Blinka pins, the
+Adafruit I2C sensors, the SH1106 display, the Dynamixel SDK, cv2.VideoCapture and the
+Survey3 cameras with their SD cards.
+"""
+
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+
+import cv2
+import numpy as np
+
+# AX-12 moving speed unit is 0.111 rpm, 0 means the maximum speed
+AX12_RPM_PER_UNIT = 0.111
+AX12_MAX_RPM = 114
+AX12_UNITS_PER_DEGREE = 1023 / 300
+AX12_TRANSACTION_TIME = 0.0005
+SURVEY3_IMAGE_SIZE = (1600, 1200)
+SURVEY3_SHOT_TIME = 0.8
+# Pulse widths understood by the PWM input of the Survey3
+SURVEY3_DO_NOTHING = 0.001
+SURVEY3_TRANSFER = 0.0015
+SURVEY3_TAKE_PHOTO = 0.002
+# Time a UVC camera takes to restart its stream in another format
+FORMAT_CHANGE_TIME = 0.3
+
+
+class Board:
+    """Pin names of the Raspberry Pi, any attribute is a valid pin"""
+
+    def __getattr__(self, name: str) -> str:
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return name
+
+
+board = Board()
+
+
+class Direction:
+    INPUT = "input"
+    OUTPUT = "output"
+
+
+class Pull:
+    UP = "up"
+    DOWN = "down"
+
+
+class DigitalInOut:
+    """GPIO pin. Inputs read their pull, so buttons with a pull up aren't pressed"""
+
+    def __init__(self, pin):
+        self.pin = pin
+        self.direction = Direction.INPUT
+        self._pull = None
+        self._value = False
+
+    @property
+    def pull(self):
+        return self._pull
+
+    @pull.setter
+    def pull(self, pull):
+        self._pull = pull
+        self._value = pull == Pull.UP
+
+    @property
+    def value(self) -> bool:
+        return self._value
+
+    @value.setter
+    def value(self, value: bool):
+        self._value = bool(value)
+
+
+class DigitalIO:
+    """Namespace matching the digitalio module"""
+
+    Direction = Direction
+    Pull = Pull
+    DigitalInOut = DigitalInOut
+
+
+digitalio = DigitalIO()
+
+
+class I2C:
+    def __init__(self, scl=None, sda=None):
+        self.scl = scl
+        self.sda = sda
+
+
+class BusIO:
+    """Namespace matching the busio module"""
+
+    I2C = I2C
+
+
+busio = BusIO()
+
+
+def noisy(base: float, spread: float) -> float:
+    return base + random.uniform(-spread, spread)
+
+
+class DHT22:
+    """Temperature and humidity sensor, slow and failing now and then like the real one"""
+
+    READ_TIME = 0.25
+    FAILURE_RATE = 0.1
+
+    def __init__(self, pin, use_pulseio: bool = True):
+        self.pin = pin
+        self.temperature: float | None = None
+        self.humidity: float | None = None
+
+    def measure(self):
+        time.sleep(self.READ_TIME)
+        if random.random() < self.FAILURE_RATE:
+            raise RuntimeError("Checksum did not validate. Try again.")
+        self.temperature = round(noisy(24, 1.5), 1)
+        self.humidity = round(noisy(65, 5), 1)
+
+
+class BH1750:
+    def __init__(self, i2c: I2C):
+        self.i2c = i2c
+
+    @property
+    def lux(self) -> float:
+        return noisy(450, 40)
+
+
+class TSL2561:
+    def __init__(self, i2c: I2C):
+        self.i2c = i2c
+
+    @property
+    def infrared(self) -> float:
+        return noisy(120, 15)
+
+
+class LTR390:
+    def __init__(self, i2c: I2C):
+        self.i2c = i2c
+
+    @property
+    def uvi(self) -> float:
+        return max(noisy(0.4, 0.2), 0)
+
+
+class SensorModule:
+    """Namespace matching an adafruit sensor module"""
+
+    def __init__(self, **classes):
+        self.__dict__.update(classes)
+
+
+adafruit_dht = SensorModule(DHT22=DHT22)
+adafruit_bh1750 = SensorModule(BH1750=BH1750)
+adafruit_tsl2561 = SensorModule(TSL2561=TSL2561)
+adafruit_ltr390 = SensorModule(LTR390=LTR390)
+
+
+def luma_i2c(port: int = 1, address: int = 0x3C):
+    return address
+
+
+class SH1106:
+    """128x64 OLED display that keeps the last image it was given"""
+
+    def __init__(self, serial_interface=None, width: int = 128, height: int = 64):
+        self.width = width
+        self.height = height
+        self.mode = "1"
+        self.image = None
+        self.sent = 0
+
+    def preprocess(self, image):
+        return image
+
+    def display(self, image):
+        self.image = image.copy()
+        self.sent += self.width * self.height // 8
+
+    def command(self, *cmd):
+        self.sent += len(cmd)
+
+    def data(self, data):
+        self.sent += len(data)
+
+
+class Ax12Motor:
+    """Control table and motion model of a single AX-12"""
+
+    def __init__(self):
+        self.table = [0] * 50
+        self.position = 0.0
+        self.start_position = 0.0
+        self.started = time.monotonic()
+
+    def register(self, address: int) -> int:
+        return self.table[address] | (self.table[address + 1] << 8)
+
+    def units_per_second(self) -> float:
+        speed = self.register(30 + 2)
+        rpm = (
+            AX12_MAX_RPM if speed == 0 else min(speed * AX12_RPM_PER_UNIT, AX12_MAX_RPM)
+        )
+        return rpm * 6 * AX12_UNITS_PER_DEGREE
+
+    def present_position(self) -> float:
+        goal = self.register(30)
+        travel = self.units_per_second() * (time.monotonic() - self.started)
+        distance = goal - self.start_position
+        if abs(distance) <= travel:
+            return goal
+        return self.start_position + travel * (1 if distance > 0 else -1)
+
+    def write(self, address: int, values: list[int]):
+        if address in (30, 32):
+            # Restart the motion from where the motor is right now
+            self.start_position = self.present_position()
+            self.started = time.monotonic()
+        for offset, value in enumerate(values):
+            self.table[address + offset] = value & 0xFF
+
+    def read(self, address: int, length: int) -> list[int]:
+        position = round(self.present_position())
+        self.table[36] = position & 0xFF
+        self.table[37] = position >> 8
+        self.table[46] = int(position != self.register(30))
+        return self.table[address : address + length]
+
+
+class PortHandler:
+    def __init__(self, device_name: str):
+        self.device_name = device_name
+
+    def openPort(self) -> bool:  # pylint: disable=invalid-name
+        return True
+
+    def setBaudRate(self, baudrate: int) -> bool:  # pylint: disable=invalid-name
+        return True
+
+    def closePort(self):  # pylint: disable=invalid-name
+        pass
+
+
+class PacketHandler:
+    """Dynamixel protocol 1.0 handler talking to simulated motors"""
+
+    motors: dict[int, Ax12Motor] = {}
+
+    def __init__(self, protocol_version: float = 1.0):
+        self.protocol_version = protocol_version
+        self.lock = threading.Lock()
+
+    def motor(self, motor_id: int) -> Ax12Motor:
+        return PacketHandler.motors.setdefault(motor_id, Ax12Motor())
+
+    def transaction(self):
+        time.sleep(AX12_TRANSACTION_TIME)
+
+    def write1ByteTxRx(
+        self, port, motor_id, address, value
+    ):  # pylint: disable=invalid-name
+        with self.lock:
+            self.transaction()
+            self.motor(motor_id).write(address, [value])
+        return 0, 0
+
+    def write2ByteTxRx(
+        self, port, motor_id, address, value
+    ):  # pylint: disable=invalid-name
+        with self.lock:
+            self.transaction()
+            self.motor(motor_id).write(address, [value & 0xFF, value >> 8])
+        return 0, 0
+
+    def readTxRx(self, port, motor_id, address, length):  # pylint: disable=invalid-name
+        with self.lock:
+            self.transaction()
+            return self.motor(motor_id).read(address, length), 0, 0
+
+    def read1ByteTxRx(self, port, motor_id, address):  # pylint: disable=invalid-name
+        data, result, error = self.readTxRx(port, motor_id, address, 1)
+        return data[0], result, error
+
+    def read2ByteTxRx(self, port, motor_id, address):  # pylint: disable=invalid-name
+        data, result, error = self.readTxRx(port, motor_id, address, 2)
+        return data[0] | (data[1] << 8), result, error
+
+    def getTxRxResult(self, result) -> str:  # pylint: disable=invalid-name
+        return f"[TxRxResult] {result}"
+
+    def getRxPacketError(self, error) -> str:  # pylint: disable=invalid-name
+        return f"[RxPacketError] {error}"
+
+
+class VideoCapture:
+    """UVC camera producing synthetic frames at the configured size and frame rate"""
+
+    def __init__(self, index: int):
+        self.index = index
+        self.props: dict[int, float] = {
+            cv2.CAP_PROP_FRAME_WIDTH: 640,
+            cv2.CAP_PROP_FRAME_HEIGHT: 480,
+            cv2.CAP_PROP_FPS: 30,
+        }
+        self.count = 0
+        self.next_frame = time.monotonic()
+        self.background: np.ndarray | None = None
+        self.canvas: np.ndarray | None = None
+
+    def isOpened(self) -> bool:  # pylint: disable=invalid-name
+        return True
+
+    def set(self, prop: int, value: float) -> bool:
+        if prop in (cv2.CAP_PROP_FRAME_WIDTH, cv2.CAP_PROP_FRAME_HEIGHT):
+            if self.props.get(prop) != value:
+                self.next_frame = time.monotonic() + FORMAT_CHANGE_TIME
+                self.canvas = None
+        self.props[prop] = value
+        self.background = None
+        return True
+
+    def get(self, prop: int) -> float:
+        return self.props.get(prop, 0)
+
+    def create_background(self, width: int, height: int) -> np.ndarray:
+        """Gradient twice as wide as the frame, sliding over it fakes the rotation"""
+        x = np.linspace(0, 255, width * 2, dtype=np.float32)
+        y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+        background = np.empty((height, width * 2, 3), dtype=np.uint8)
+        background[..., 0] = (x[None, :] + y) / 2
+        background[..., 1] = np.abs(np.sin(x / 40)) * 255 * (y / 255)
+        background[..., 2] = 255 - x[None, :] / 2 + self.index * 20
+        return background
+
+    def compressed(self) -> bool:
+        """Whether the frames are returned as the JPEG the camera sent"""
+        return self.props.get(cv2.CAP_PROP_CONVERT_RGB, 1) == 0 and self.props.get(
+            cv2.CAP_PROP_FOURCC
+        ) == cv2.VideoWriter_fourcc(*"MJPG")
+
+    def read(self, image: np.ndarray | None = None):
+        compressed = self.compressed()
+        if compressed:
+            # The JPEG is drawn on a canvas of its own, a real camera encodes it
+            image = self.canvas
+        width = int(self.props[cv2.CAP_PROP_FRAME_WIDTH])
+        height = int(self.props[cv2.CAP_PROP_FRAME_HEIGHT])
+        if self.background is None:
+            self.background = self.create_background(width, height)
+
+        # Deliver frames at the camera's pace like a real device
+        delay = self.next_frame - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        self.next_frame = max(self.next_frame, time.monotonic()) + 1 / max(
+            self.props[cv2.CAP_PROP_FPS], 1
+        )
+
+        if image is None or image.shape != (height, width, 3):
+            image = np.empty((height, width, 3), dtype=np.uint8)
+        offset = (self.count * 4) % width
+        image[:] = self.background[:, offset : offset + width]
+        cv2.putText(
+            image,
+            f"CAM {self.index} #{self.count}",
+            (10, 30),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            0.8,
+            (255, 255, 255),
+            2,
+        )
+        self.count += 1
+        if compressed:
+            self.canvas = image
+            _, buffer = cv2.imencode(".jpg", image)
+            return True, buffer.reshape(1, -1)
+        return True, image
+
+    def release(self):
+        pass
+
+
+class Survey3Trigger(DigitalInOut):
+    """PWM input of a Survey3 camera. Taking a photo writes a JPEG to the SD card and a
+    transfer pulse mounts or dismounts it, making the photo directory appear or disappear
+    like the real USB storage.
+    """
+
+    def __init__(self, pin, origin: str):
+        super().__init__(pin)
+        self.origin = origin
+        self.mount_point = os.path.dirname(os.path.dirname(origin))
+        self.hidden = os.path.join(
+            os.path.dirname(self.mount_point),
+            "." + os.path.basename(self.mount_point),
+        )
+        os.makedirs(os.path.join(self.hidden, "DCIM", "Photo"), exist_ok=True)
+        self.shots = 0
+
+    def pulse(self, width: float):
+        """Receive a pulse. Its width is taken as sent, the timing of a busy single core
+        machine running the simulation is too coarse to measure it
+        """
+        self.value = True
+        time.sleep(width)
+        self.value = False
+        self.decode(width)
+
+    @property
+    def mounted(self) -> bool:
+        return os.path.isdir(self.mount_point)
+
+    def decode(self, width: float):
+        """Act on the nominal pulse closest to the width"""
+        nominal = min(
+            (SURVEY3_DO_NOTHING, SURVEY3_TRANSFER, SURVEY3_TAKE_PHOTO),
+            key=lambda pulse: abs(pulse - width),
+        )
+        if nominal == SURVEY3_TRANSFER:
+            self.toggle_mount()
+        elif nominal == SURVEY3_TAKE_PHOTO:
+            self.take_photo()
+
+    def toggle_mount(self):
+        if self.mounted:
+            os.rename(self.mount_point, self.hidden)
+        else:
+            os.rename(self.hidden, self.mount_point)
+        logging.debug("Simulated Survey3 %s mounted: %s", self.pin, self.mounted)
+
+    def take_photo(self):
+        if self.mounted:
+            logging.warning(
+                "Simulated Survey3 %s ignored a photo while mounted", self.pin
+            )
+            return
+        # The camera needs a while to write the photo, do it off the caller's thread
+        threading.Thread(
+            target=self.write_photo, args=(self.shots,), daemon=True
+        ).start()
+        self.shots += 1
+
+    def write_photo(self, shot: int):
+        width, height = SURVEY3_IMAGE_SIZE
+        image = np.random.randint(0, 255, (height // 8, width // 8, 3), dtype=np.uint8)
+        image = cv2.resize(image, (width, height), interpolation=cv2.INTER_LINEAR)
+        success, buffer = cv2.imencode(".jpg", image)
+        time.sleep(SURVEY3_SHOT_TIME)
+        if not success:
+            return
+        photo = os.path.join(self.hidden, "DCIM", "Photo", f"{shot:04d}.JPG")
+        with open(photo, "wb") as file:
+            file.write(buffer.tobytes())
+
+
+def create_sd_root() -> str:
+    """Temporary directory where the simulated Survey3 SD cards get mounted"""
+    return tempfile.mkdtemp(prefix="survey3-")
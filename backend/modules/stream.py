@@ -0,0 +1,309 @@
+"""Encode-once MJPEG broadcasting of camera frames to any number of HTTP clients.
+
+Clients ask for a tier, a width and JPEG quality, every new frame is downscaled and
+encoded once per tier being watched. Each client also has its own frame rate, lowered
+automatically while its connection can't keep up.
+"""
+
+import logging
+import threading
+import time
+from typing import NamedTuple
+
+import cv2
+import numpy as np
+
+import metrics
+from modules.framebuffer import REDUCED_DECODE, Frame
+
+BOUNDARY = b"--frame\r\nContent-Type: image/jpeg\r\n\r\n"
+SUBSCRIBER_TIMEOUT = 1.0
+
+DEFAULT_QUALITY = 95
+MIN_QUALITY = 10
+# Requested widths and qualities are rounded so similar clients share a tier
+WIDTH_STEP = 16
+QUALITY_STEP = 5
+MIN_WIDTH = 64
+MIN_FPS = 0.5
+# A frame that takes longer than this fraction of the interval to send halves the rate,
+# one sent in less than the other fraction raises it again by FPS_STEP
+SLOW_SEND = 1.0
+FAST_SEND = 0.25
+FPS_STEP = 0.5
+
+
+class Tier(NamedTuple):
+    """Width and JPEG quality shared by the clients of an encoded stream"""
+
+    width: int | None
+    quality: int
+
+
+def create_tier(
+    width: int | None, quality: int | None, max_width: int | None = None
+) -> Tier:
+    """Round the requested width and quality to the nearest tier
+    Args:
+        width: Width of the frames in pixels, None for the camera resolution
+        quality: JPEG quality between 0 and 100, None for the default
+        max_width: Width of the camera, any larger width streams the frames as they are
+    """
+    if width is not None:
+        width = max(MIN_WIDTH, round(width / WIDTH_STEP) * WIDTH_STEP)
+        if max_width is not None and width >= max_width:
+            width = None
+    if quality is None:
+        quality = DEFAULT_QUALITY
+    quality = round(quality / QUALITY_STEP) * QUALITY_STEP
+    return Tier(width, min(DEFAULT_QUALITY, max(MIN_QUALITY, quality)))
+
+
+NATIVE_TIER = create_tier(None, None)
+
+
+def create_blank_jpeg():
+    """Create a 1x1 black pixel (uint8, BGR)"""
+    img = np.zeros((1, 1, 3), dtype=np.uint8)
+
+    success, buffer = cv2.imencode(".jpg", img)
+    if not success:
+        return b""  # fallback
+    return buffer.tobytes()
+
+
+def format_part(jpeg: bytes) -> bytes:
+    """Wrap JPEG bytes as a part of a multipart/x-mixed-replace response"""
+    return BOUNDARY + jpeg + b"\r\n"
+
+
+class StreamRate:
+    """Frame rate of a single client. Halved whenever a frame takes longer to send than
+    the interval between frames, raised back step by step while the client keeps up.
+    """
+
+    def __init__(self, fps: float):
+        self.max_fps = fps
+        self.fps = fps
+
+    @property
+    def interval(self) -> float:
+        return 1.0 / self.fps
+
+    def sent(self, seconds: float):
+        """Adapt the rate to the time the last frame took to be sent"""
+        if seconds > self.interval * SLOW_SEND:
+            self.fps = max(MIN_FPS, self.fps / 2)
+        elif seconds < self.interval * FAST_SEND:
+            self.fps = min(self.max_fps, self.fps + FPS_STEP)
+
+
+class Subscriber:
+    """A single viewer of a broadcast. Holds only the latest part, older ones are dropped."""
+
+    def __init__(self, tier: Tier):
+        self.tier = tier
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.part: bytes | None = None
+        # Monotonic time the viewer wants its next frame at, no frame is encoded for it
+        # before then
+        self.due = 0.0
+        self.dropped = 0
+
+    def offer(self, part: bytes):
+        """Replace the pending part with a newer one without ever blocking the broadcaster"""
+        with self.lock:
+            if self.part is not None:
+                self.dropped += 1
+            self.part = part
+            self.ready.set()
+
+    def take(self, timeout: float) -> bytes | None:
+        """Wait for the next part
+        Args:
+            timeout: Maximum seconds to wait for a part
+        Returns:
+            The latest part or None if nothing arrived in time
+        """
+        if not self.ready.wait(timeout):
+            return None
+        with self.lock:
+            part, self.part = self.part, None
+            self.ready.clear()
+        return part
+
+
+class FrameBroadcaster(threading.Thread):
+    """Encodes each new frame of a camera once and fans the bytes out to every subscriber"""
+
+    def __init__(self, camera, stop_event: threading.Event):
+        super().__init__(daemon=True)
+        self.camera = camera
+        self.stop_event = stop_event
+        self.lock = threading.Lock()
+        self.subscribers: dict[Tier, set[Subscriber]] = {}
+        self.blank = format_part(create_blank_jpeg())
+        # Frames encoded here and camera JPEGs sent as they came
+        self.encoded = 0
+        self.passthrough = 0
+
+    def viewers(self) -> int:
+        return sum(len(subscribers) for subscribers in self.subscribers.values())
+
+    def subscribe(self, tier: Tier) -> Subscriber:
+        subscriber = Subscriber(tier)
+        with self.lock:
+            self.subscribers.setdefault(tier, set()).add(subscriber)
+            viewers = self.viewers()
+        logging.info(
+            "Camera %d gained a viewer at %s (%d total).",
+            self.camera.device_index,
+            tier,
+            viewers,
+        )
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        with self.lock:
+            subscribers = self.subscribers.get(subscriber.tier, set())
+            subscribers.discard(subscriber)
+            if not subscribers:
+                self.subscribers.pop(subscriber.tier, None)
+            viewers = self.viewers()
+        logging.info(
+            "Camera %d lost a viewer (%d left, %d frames dropped).",
+            self.camera.device_index,
+            viewers,
+            subscriber.dropped,
+        )
+
+    def due_subscribers(self) -> dict[Tier, list[Subscriber]]:
+        """The subscribers waiting for a frame by tier, the others are skipped"""
+        now = time.monotonic()
+        with self.lock:
+            due = {
+                tier: [
+                    subscriber for subscriber in subscribers if subscriber.due <= now
+                ]
+                for tier, subscribers in self.subscribers.items()
+            }
+        return {tier: subscribers for tier, subscribers in due.items() if subscribers}
+
+    def scale(self, frame: Frame, width: int | None, scaled: dict) -> np.ndarray | None:
+        """Get the pixels of a frame at most the given width wide
+        Args:
+            frame: The frame as captured
+            width: The width of the tier, None for the full frame
+            scaled: Decoded and downscaled copies of the frame by width, shared between
+                the tiers
+        """
+        if width not in scaled:
+            # A JPEG is decoded straight at the smallest size still wider than the tier
+            reduction = 1
+            if frame.compressed and width is not None:
+                reduction = max(
+                    (r for r in REDUCED_DECODE if self.camera.width // r >= width),
+                    default=1,
+                )
+            image = frame.decode(reduction)
+            if image is not None and width is not None and width < image.shape[1]:
+                height = image.shape[0] * width // image.shape[1]
+                image = cv2.resize(  # pylint: disable=no-member
+                    image,
+                    (width, max(1, height)),
+                    interpolation=cv2.INTER_AREA,  # pylint: disable=no-member
+                )
+            scaled[width] = image
+        return scaled[width]
+
+    def encode(self, frame: Frame, tier: Tier, scaled: dict) -> bytes | None:
+        """Downscale and encode a frame for a tier. The JPEG sent by the camera goes out
+        untouched to the tier of full size and default quality.
+        Args:
+            frame: The frame as captured
+            tier: The width and quality to encode at
+            scaled: Decoded and downscaled copies of the frame, shared between the tiers
+        Returns:
+            The formatted part or None if the encoding failed
+        """
+        if frame.compressed and tier == NATIVE_TIER:
+            self.passthrough += 1
+            return format_part(frame.image.tobytes())
+
+        image = self.scale(frame, tier.width, scaled)
+        if image is None:
+            logging.error(
+                "Camera %d sent a corrupt JPEG frame.", self.camera.device_index
+            )
+            return None
+
+        started = time.perf_counter()
+        try:
+            success, buffer = cv2.imencode(  # pylint: disable=no-member
+                ".jpg",
+                image,
+                [cv2.IMWRITE_JPEG_QUALITY, tier.quality],  # pylint: disable=no-member
+            )
+        except cv2.error:  # pylint: disable=catching-non-exception
+            success = False
+        metrics.camera_encode.observe(self.camera.prefix, time.perf_counter() - started)
+        if not success:
+            logging.error(
+                "Camera %d failed during image encoding.", self.camera.device_index
+            )
+            return None
+        self.encoded += 1
+        return format_part(buffer.tobytes())
+
+    def run(self):
+        """Wait for new frames and encode them only while someone is watching"""
+        seq = 0
+        while not self.stop_event.is_set():
+            frame = self.camera.wait_frame(seq, SUBSCRIBER_TIMEOUT)
+            if frame is None:
+                continue
+            seq = frame.seq
+
+            scaled = {}
+            for tier, subscribers in self.due_subscribers().items():
+                part = self.encode(frame, tier, scaled)
+                if part is None:
+                    continue
+                for subscriber in subscribers:
+                    subscriber.offer(part)
+
+    def stream(
+        self,
+        width: int | None = None,
+        quality: int | None = None,
+        fps: float | None = None,
+    ):
+        """Generator of multipart parts for a single HTTP client
+        Args:
+            width: Width of the frames in pixels, None for the camera resolution
+            quality: JPEG quality, None for the default
+            fps: Maximum frames per second, None for the rate of the camera
+        Returns:
+            The HTTP streaming formatted frames, a blank frame whenever the camera stalls
+        """
+        max_fps = self.camera.fps if fps is None else min(fps, self.camera.fps)
+        rate = StreamRate(max(MIN_FPS, max_fps))
+        subscriber = self.subscribe(create_tier(width, quality, self.camera.width))
+        try:
+            yield self.blank
+            while not self.stop_event.is_set():
+                # No part comes before the subscriber is due, only a longer wait after
+                # that means the camera stalled
+                waiting = max(0.0, subscriber.due - time.monotonic())
+                part = subscriber.take(waiting + SUBSCRIBER_TIMEOUT)
+                if part is None:
+                    yield self.blank
+                    continue
+                started = time.monotonic()
+                # Blocks while the server can't write more to the socket
+                yield part
+                rate.sent(time.monotonic() - started)
+                subscriber.due = started + rate.interval
+        finally:
+            self.unsubscribe(subscriber)
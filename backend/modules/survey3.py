@@ -1,11 +1,20 @@
+import heapq
 import logging
 import shutil
 import time
-from os import listdir, path, remove
-
-import digitalio
-
-from utils import generate_photo_name, get_session_dirpath, safe_copy
+from os import listdir, path, remove, scandir
+
+import metrics
+from events import publish_photo
+from hardware import digitalio, send_pulse
+from manifest import get_manifest
+from scheduler import run_blocking
+from utils import (
+    TransferProgress,
+    generate_photo_name,
+    get_session_dirpath,
+    safe_copy,
+)
 
 logging.basicConfig(
     format=(
@@ -20,6 +29,16 @@ logging.basicConfig(
 )
 
 
+PULSE_GAP = 0.1
+READ_TIME = 1
+MOUNT_TIME = 3
+
+
+def picture_ext(src: str) -> str:
+    """Extension of a picture on the SD card, kept by its copy in the session"""
+    return path.splitext(src)[1].lstrip(".").lower()
+
+
 class Pulse:
     DO_NOTHING = 0.001
     TAKE_PHOTO = 0.002
@@ -42,22 +61,33 @@ class Survey3:
             self.toggle_mount()
 
     def pulse(self, pulse: float):
-        self.pin.value = True
-        time.sleep(pulse)
-        self.pin.value = False
-        time.sleep(0.1)
+        run_blocking(self.pulse_task(pulse))
+
+    def pulse_task(self, pulse: float):
+        """Send a PWM pulse. Only the pulse itself blocks, the gap after it is yielded"""
+        send_pulse(self.pin, pulse)
+        yield PULSE_GAP
 
     def read(self):
-        self.pulse(Pulse.DO_NOTHING)
-        self.pulse(Pulse.TAKE_PHOTO)
-        self.pulse(Pulse.DO_NOTHING)
-        time.sleep(1)
+        run_blocking(self.read_task())
+
+    @metrics.timed("survey3_read")
+    def read_task(self):
+        """Trigger a photo, yielding the waits so other tasks can run meanwhile"""
+        yield from self.pulse_task(Pulse.DO_NOTHING)
+        yield from self.pulse_task(Pulse.TAKE_PHOTO)
+        yield from self.pulse_task(Pulse.DO_NOTHING)
+        yield READ_TIME
 
     def toggle_mount(self):
-        self.pulse(Pulse.DO_NOTHING)
-        self.pulse(Pulse.TRANSFER)
-        self.pulse(Pulse.DO_NOTHING)
-        time.sleep(3)
+        run_blocking(self.toggle_mount_task())
+
+    def toggle_mount_task(self):
+        """Mount or dismount the SD card, yielding the waits"""
+        yield from self.pulse_task(Pulse.DO_NOTHING)
+        yield from self.pulse_task(Pulse.TRANSFER)
+        yield from self.pulse_task(Pulse.DO_NOTHING)
+        yield MOUNT_TIME
 
     def transfer_latest(self):
         if not path.exists(self.origin):
@@ -75,13 +105,51 @@ class Survey3:
             logging.error("No files found in %s.", self.origin)
             return False
 
-        safe_copy(
-            latest, path.join(self.dest, generate_photo_name(self.id, time.time(), 0))
-        )
+        filename = generate_photo_name(self.id, time.time(), 0, picture_ext(latest))
+        safe_copy(latest, path.join(self.dest, filename))
         remove(latest)
         return True
 
-    def transfer_n(self, n: int, session: int, timestamp: float = 0):
+    def newest_files(self, n: int) -> list[tuple[float, str, int]]:
+        """Single pass over the SD card keeping only the n newest pictures
+        Args:
+            n: The amount of pictures to keep
+        Returns:
+            The creation time, path and size of each picture, newest first
+        """
+        if not path.exists(self.origin):
+            return []
+
+        with scandir(self.origin) as entries:
+            files = []
+            for entry in entries:
+                if entry.name.lower().endswith((".jpg", ".jpeg", ".png")):
+                    stat = entry.stat()
+                    files.append((stat.st_ctime, entry.path, stat.st_size))
+        return heapq.nlargest(n, files)
+
+    def pending_bytes(self, n: int) -> int:
+        """The amount of bytes transfer_n would copy"""
+        return sum(size for _, _, size in self.newest_files(n))
+
+    @metrics.timed("survey3_transfer")
+    def transfer_n(
+        self,
+        n: int,
+        session: int,
+        timestamp: float = 0,
+        progress: TransferProgress | None = None,
+    ):
+        """Copy the n newest pictures into the session directory. The sources are deleted
+        only after their copy was verified.
+        Args:
+            n: The amount of pictures to transfer
+            session: The number of the session the pictures belong to
+            timestamp: The timestamp to use for the filenames
+            progress: Counter of the bytes copied, shared with other transfers
+        Returns:
+            Whether every picture was transferred and verified
+        """
         if timestamp == 0:
             timestamp = time.time()
 
@@ -89,35 +157,34 @@ class Survey3:
             logging.error("The directory %s does not exist.", self.origin)
             return False
 
-        files = [
-            f
-            for f in listdir(self.origin)
-            if f.lower().endswith((".jpg", ".jpeg", ".png"))
-        ]
-        files = sorted(
-            files, key=lambda x: path.getctime(path.join(self.origin, x)), reverse=True
-        )
-
-        if len(files) < n:
+        newest = self.newest_files(n)
+        if len(newest) < n:
             logging.error(
                 "Not enough files found in %s. Expected %d, found %d",
                 self.origin,
                 n,
-                len(files),
+                len(newest),
             )
             return False
 
-        for i, file in enumerate(files[:n]):
-            src = path.join(self.origin, file)
-            dst = path.join(
-                get_session_dirpath(self.dest, session),
-                generate_photo_name(self.id, timestamp, i),
+        dirpath = get_session_dirpath(self.dest, session)
+        manifest = get_manifest(dirpath)
+        verified = True
+        for i, (_, src, _) in enumerate(newest):
+            filename = generate_photo_name(self.id, timestamp, i, picture_ext(src))
+            crc = safe_copy(
+                src,
+                path.join(dirpath, filename),
+                on_progress=progress.add if progress else None,
             )
-
-            safe_copy(src, dst)
-            remove(src)
-
-        return True
+            if crc is not None:
+                publish_photo(session, manifest.add(filename, crc32=crc))
+                remove(src)
+            else:
+                logging.error("Kept %s on the SD card, its copy failed.", src)
+                verified = False
+
+        return verified
 
     def clear_sd(self):
         if not path.exists(self.origin):
@@ -0,0 +1,251 @@
+"""Background pool that encodes and persists still images off the control loop.
+
+Stills are encoded in a pool of processes, one per core, and written by as many threads.
+The encoders are started from a fork server that only imports this module, so they
+don't inherit the state of the control loop.
+"""
+
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, NamedTuple
+
+import cv2
+from cv2.typing import MatLike
+
+import metrics
+
+ENCODER_PROCESSES = os.cpu_count() or 1
+WRITER_WORKERS = ENCODER_PROCESSES
+WRITER_CAPACITY = 8
+LATENCY_HISTORY = 100
+PNG_LEVEL = 1
+JPEG_QUALITY = 95
+# LZW, lossless and understood by every TIFF reader
+TIFF_COMPRESSION = 5
+
+
+class Encoder(NamedTuple):
+    """Format of the stills of a camera and the OpenCV parameters to encode them with"""
+
+    ext: str
+    params: tuple[int, ...] = ()
+
+    def encode(self, frame: MatLike) -> bytes:
+        success, buffer = cv2.imencode(  # pylint: disable=no-member
+            f".{self.ext}", frame, self.params
+        )
+        if not success:
+            raise OSError(f"cv2.imencode failed encoding {self.ext}")
+        return buffer.tobytes()
+
+
+def png(level: int = PNG_LEVEL) -> Encoder:
+    """Lossless PNG, levels go from 0 (fastest, largest) to 9 (slowest, smallest)"""
+    return Encoder(
+        "png", (cv2.IMWRITE_PNG_COMPRESSION, level)  # pylint: disable=no-member
+    )
+
+
+def webp_lossless() -> Encoder:
+    """Lossless WebP, selected by any quality above 100"""
+    return Encoder("webp", (cv2.IMWRITE_WEBP_QUALITY, 101))  # pylint: disable=no-member
+
+
+def jpeg(quality: int = JPEG_QUALITY) -> Encoder:
+    return Encoder(
+        "jpg", (cv2.IMWRITE_JPEG_QUALITY, quality)  # pylint: disable=no-member
+    )
+
+
+def tiff(compression: int = TIFF_COMPRESSION) -> Encoder:
+    return Encoder(
+        "tiff", (cv2.IMWRITE_TIFF_COMPRESSION, compression)  # pylint: disable=no-member
+    )
+
+
+DEFAULT_ENCODER = png()
+ENCODERS: dict[str, Callable[..., Encoder]] = {
+    "png": png,
+    "webp": webp_lossless,
+    "jpeg": jpeg,
+    "tiff": tiff,
+}
+# Values the number of each format may take, None if it takes none
+ENCODER_ARGS: dict[str, range | None] = {
+    "png": range(10),
+    "webp": None,
+    "jpeg": range(101),
+    "tiff": range(1 << 16),
+}
+
+
+def parse_encoders(specs: str) -> dict[str, Encoder]:
+    """Encoder of each camera from a spec like "RGB=png:1,RGBT=webp"
+    Args:
+        specs: Comma separated label=format pairs, the format may take one number
+    Returns:
+        The encoder of each camera label, a ValueError names the first invalid pair
+    """
+    encoders = {}
+    for spec in filter(None, (spec.strip() for spec in specs.split(","))):
+        label, _, fmt = spec.partition("=")
+        name, _, arg = fmt.partition(":")
+        if not label or name not in ENCODERS:
+            raise ValueError(f"Invalid still format {spec!r}")
+        if not arg:
+            encoders[label] = ENCODERS[name]()
+            continue
+        allowed = ENCODER_ARGS[name]
+        if allowed is None or not arg.isdigit() or int(arg) not in allowed:
+            raise ValueError(f"Invalid still format {spec!r}")
+        encoders[label] = ENCODERS[name](int(arg))
+    return encoders
+
+
+def encode(encoder: Encoder, frame: MatLike) -> bytes:
+    """Entry point of the encoder processes"""
+    return encoder.encode(frame)
+
+
+def create_pool(processes: int = ENCODER_PROCESSES) -> Executor:
+    """Process pool for the encoders, forked from a server that only loads this module"""
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload([__name__])
+    return ProcessPoolExecutor(processes, mp_context=context)
+
+
+class ImageWriter:
+    """Bounded queue of frames written to disk by a small set of worker threads"""
+
+    def __init__(
+        self,
+        workers: int = WRITER_WORKERS,
+        capacity: int = WRITER_CAPACITY,
+        processes: int = ENCODER_PROCESSES,
+    ):
+        """
+        Args:
+            workers: Threads waiting for the encoders and writing the files
+            capacity: Images that may be queued before submit blocks
+            processes: Encoder processes, 0 encodes on the worker threads instead
+        """
+        self.workers = workers
+        self.processes = processes
+        self.pool: Executor | None = None
+        self.queue: queue.Queue = queue.Queue(maxsize=capacity)
+        self.lock = threading.Lock()
+        self.threads: list[threading.Thread] = []
+        self.latencies: deque[float] = deque(maxlen=LATENCY_HISTORY)
+        self.failed = 0
+
+    def start(self):
+        """Start the worker threads if they aren't running yet"""
+        with self.lock:
+            if self.threads:
+                return
+            if self.processes > 0:
+                self.pool = self.create_pool()
+            for i in range(self.workers):
+                thread = threading.Thread(
+                    target=self.work, name=f"ImageWriter-{i}", daemon=True
+                )
+                thread.start()
+                self.threads.append(thread)
+
+    def create_pool(self) -> Executor:
+        pool = create_pool(self.processes)
+        # Start the processes now rather than on the first still
+        for _ in range(self.processes):
+            pool.submit(os.getpid)
+        return pool
+
+    def encode(self, frame: MatLike, encoder: Encoder) -> bytes:
+        """Encode in the pool, replacing it once if one of its processes died"""
+        pool = self.pool
+        if pool is None:
+            return encoder.encode(frame)
+        try:
+            return pool.submit(encode, encoder, frame).result()
+        except BrokenProcessPool:
+            with self.lock:
+                # Another worker may have replaced it already
+                if self.pool is pool:
+                    logging.error("An encoder process died, restarting the pool.")
+                    pool.shutdown(wait=False)
+                    self.pool = self.create_pool()
+                pool = self.pool
+        return pool.submit(encode, encoder, frame).result()
+
+    def submit(
+        self,
+        path: str,
+        frame: MatLike,
+        on_saved: Callable[[int], None] | None = None,
+        encoder: Encoder | None = None,
+    ):
+        """Queue a frame to be written. Blocks while the queue is full
+        Args:
+            path: The full path of the destination file
+            frame: The image to save. Must not be modified after submitting it
+            on_saved: Called from the worker with the CRC32 of the file once it was
+                written successfully
+            encoder: The format to save in, by default the one of the path's extension
+        """
+        if encoder is None:
+            encoder = Encoder(os.path.splitext(path)[1].lstrip(".").lower())
+        self.start()
+        item = (path, frame, encoder, on_saved, time.perf_counter())
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            logging.warning("Image writer queue is full, waiting to save %s", path)
+            self.queue.put(item)
+
+    def flush(self, timeout: float | None = None) -> bool:
+        """Wait until every queued image has been written
+        Args:
+            timeout: Maximum seconds to wait, forever if None
+        Returns:
+            Whether the queue was drained in time
+        """
+        with self.queue.all_tasks_done:
+            return self.queue.all_tasks_done.wait_for(
+                lambda: self.queue.unfinished_tasks == 0, timeout
+            )
+
+    def work(self):
+        """Worker loop, writes the queued images forever"""
+        while True:
+            path, frame, encoder, on_saved, queued = self.queue.get()
+            try:
+                started = time.perf_counter()
+                encoded = self.encode(frame, encoder)
+                written = time.perf_counter()
+                with open(path, "wb") as file:
+                    file.write(encoded)
+                finished = time.perf_counter()
+                metrics.stages.observe("image_encode", written - started)
+                metrics.stages.observe("image_write", finished - written)
+                self.latencies.append(finished - queued)
+                logging.info(
+                    "Saved %s (%d kB) in %.0f ms (%.0f ms queued).",
+                    path,
+                    len(encoded) // 1024,
+                    (finished - started) * 1000,
+                    (started - queued) * 1000,
+                )
+                if on_saved is not None:
+                    on_saved(zlib.crc32(encoded))
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                self.failed += 1
+                logging.error("Failed saving %s: %s", path, e)
+            finally:
+                self.queue.task_done()
@@ -0,0 +1,152 @@
+"""Cooperative scheduler that runs the acquisition steps without blocking sleeps.
+
+Tasks are generators. Whenever a task has to wait it yields what it's waiting for:
+    - a number: sleep that many seconds
+    - a callable: poll it on every tick until it returns True
+    - a Task: wait until that task finished
+The scheduler resumes each task once its wait is over, so independent tasks overlap while
+the main loop keeps polling the buttons.
+"""
+
+import logging
+import time
+from collections import deque
+from typing import Callable, Generator
+
+DURATION_HISTORY = 50
+IDLE_TICK = 0.1
+
+TaskGenerator = Generator[object, None, object]
+
+
+class Task:
+    """A generator being run by the scheduler"""
+
+    def __init__(self, name: str, generator: TaskGenerator, started: float):
+        self.name = name
+        self.generator = generator
+        self.started = started
+        self.finished: float | None = None
+        self.result = None
+        self.wake_at = started
+        self.waiting_for: Callable[[], bool] | None = None
+
+    @property
+    def done(self) -> bool:
+        return self.finished is not None
+
+    @property
+    def duration(self) -> float | None:
+        if self.finished is None:
+            return None
+        return self.finished - self.started
+
+
+class Scheduler:
+    """Runs tasks cooperatively from the thread that calls tick()"""
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic):
+        self.clock = clock
+        self.tasks: list[Task] = []
+        self.durations: dict[str, deque[float]] = {}
+
+    def spawn(self, name: str, generator: TaskGenerator) -> Task:
+        """Add a task, it starts running on the next call to tick()
+        Args:
+            name: The name used to group its measured durations
+            generator: The task body
+        Returns:
+            The handle of the task, can be yielded by other tasks to wait for it
+        """
+        task = Task(name, generator, self.clock())
+        self.tasks.append(task)
+        return task
+
+    def busy(self, name: str | None = None) -> bool:
+        """Whether any task, or any task with the given name, is still running"""
+        return any(name is None or task.name == name for task in self.tasks)
+
+    def tick(self) -> float:
+        """Resume every task whose wait is over
+        Returns:
+            Seconds until the next task has to be resumed, capped to IDLE_TICK
+        """
+        progressed = True
+        while progressed:
+            # Tasks spawned or finished in this round may unblock others right away
+            progressed = False
+            for task in list(self.tasks):
+                progressed = self.advance(task) or progressed
+
+        now = self.clock()
+        delay = IDLE_TICK
+        for task in self.tasks:
+            if task.waiting_for is None:
+                delay = min(delay, max(0.0, task.wake_at - now))
+        return delay
+
+    def advance(self, task: Task) -> bool:
+        """Run a task until it yields something it still has to wait for
+        Returns:
+            Whether the task was resumed at all
+        """
+        resumed = False
+        while True:
+            now = self.clock()
+            if task.waiting_for is not None:
+                if not task.waiting_for():
+                    return resumed
+                task.waiting_for = None
+            elif now < task.wake_at:
+                return resumed
+
+            resumed = True
+            try:
+                wait = next(task.generator)
+            except StopIteration as stop:
+                self.finish(task, stop.value)
+                return resumed
+            except Exception:  # pylint: disable=broad-exception-caught
+                logging.exception("Task %s failed.", task.name)
+                self.finish(task, None)
+                return resumed
+
+            if isinstance(wait, Task):
+                task.waiting_for = lambda other=wait: other.done
+            elif callable(wait):
+                task.waiting_for = wait
+            else:
+                task.wake_at = self.clock() + float(wait or 0)  # type: ignore
+
+    def finish(self, task: Task, result):
+        task.result = result
+        task.finished = self.clock()
+        self.tasks.remove(task)
+        self.durations.setdefault(task.name, deque(maxlen=DURATION_HISTORY)).append(
+            task.finished - task.started
+        )
+        logging.info("Task %s finished in %.2f s.", task.name, task.duration)
+
+
+def run_blocking(generator: TaskGenerator, poll: float = 0.01):
+    """Run a task body to completion on the calling thread, sleeping for its waits
+    Args:
+        generator: The task body
+        poll: Seconds between checks when the task waits for a condition
+    Returns:
+        The value returned by the task
+    """
+    try:
+        wait = next(generator)
+        while True:
+            if isinstance(wait, Task):
+                while not wait.done:
+                    time.sleep(poll)
+            elif callable(wait):
+                while not wait():
+                    time.sleep(poll)
+            else:
+                time.sleep(float(wait or 0))  # type: ignore
+            wait = next(generator)
+    except StopIteration as stop:
+        return stop.value
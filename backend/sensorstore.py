@@ -0,0 +1,243 @@
+"""Persistent store of the sensor readings, correlated with the session being captured.
+
+Readings are buffered in memory and written in batches to a SQLite database in WAL mode,
+so the SD card sees one small append every FLUSH_INTERVAL instead of a write per reading.
+"""
+
+import csv
+import io
+import logging
+import sqlite3
+import threading
+import time
+
+FLUSH_INTERVAL = 30.0
+BATCH_SIZE = 500
+# Readings kept in memory while the database can't be written, the oldest are dropped
+MAX_PENDING = 100 * BATCH_SIZE
+# Readings taken outside of a session are only kept for a while
+IDLE_RETENTION = 7 * 24 * 60 * 60
+PRUNE_INTERVAL = 60 * 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS readings (
+    timestamp REAL NOT NULL,
+    session INTEGER,
+    sensor TEXT NOT NULL,
+    field TEXT NOT NULL,
+    value REAL
+);
+CREATE INDEX IF NOT EXISTS readings_time ON readings (timestamp);
+CREATE INDEX IF NOT EXISTS readings_session ON readings (session, timestamp)
+    WHERE session IS NOT NULL;
+"""
+COLUMNS = ("timestamp", "session", "sensor", "field", "value")
+EXPORT_CHUNK = 64 * 1024
+
+
+def reading_key(row: tuple) -> tuple:
+    """A reading as stored, without the rowid a query may add"""
+    return tuple(row[: len(COLUMNS)])
+
+
+class SensorStore(threading.Thread):
+    """Append-only table of readings, written by its own thread in batches"""
+
+    def __init__(self, path: str, stop_event: threading.Event):
+        super().__init__(name="SensorStore", daemon=True)
+        self.path = path
+        self.stop_event = stop_event
+        self.condition = threading.Condition()
+        self.pending: list[tuple] = []
+        self.written = 0
+        self.last_prune = 0.0
+        connection = self.connect()
+        try:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(SCHEMA)
+        finally:
+            connection.close()
+
+    def connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=10)
+        # WAL only needs to be synced on checkpoints, a crash loses the last batch at most
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def record(self, sensor: str, timestamp: float, session: int | None, values: dict):
+        """Queue a reading to be written with the next batch
+        Args:
+            sensor: The name of the sensor
+            timestamp: Unix time of the reading
+            session: The session being captured, None while idle
+            values: The value of every field read
+        """
+        with self.condition:
+            self.pending.extend(
+                (timestamp, session, sensor, field, value)
+                for field, value in values.items()
+            )
+            if len(self.pending) >= BATCH_SIZE:
+                self.condition.notify()
+
+    def flush(self, connection: sqlite3.Connection):
+        """Write every pending reading in a single transaction. The readings stay pending
+        until it commits, so a failed write is retried with the next batch.
+        """
+        with self.condition:
+            batch = list(self.pending)
+        if not batch:
+            return
+        try:
+            with connection:
+                connection.executemany(
+                    "INSERT INTO readings VALUES (?, ?, ?, ?, ?)", batch
+                )
+        except sqlite3.Error:
+            with self.condition:
+                dropped = len(self.pending) - MAX_PENDING
+                if dropped > 0:
+                    del self.pending[:dropped]
+                    logging.warning("Dropped %d unwritten sensor readings.", dropped)
+            raise
+        with self.condition:
+            # Only this thread flushes and record() only appends, the batch is the head
+            del self.pending[: len(batch)]
+            self.written += len(batch)
+
+    def prune(self, connection: sqlite3.Connection):
+        """Delete the old readings that don't belong to any session"""
+        with connection:
+            deleted = connection.execute(
+                "DELETE FROM readings WHERE session IS NULL AND timestamp < ?",
+                (time.time() - IDLE_RETENTION,),
+            ).rowcount
+        if deleted:
+            logging.info("Pruned %d idle sensor readings.", deleted)
+        self.last_prune = time.monotonic()
+
+    def run(self):
+        connection = self.connect()
+        try:
+            while not self.stop_event.is_set():
+                with self.condition:
+                    self.condition.wait_for(
+                        lambda: len(self.pending) >= BATCH_SIZE
+                        or self.stop_event.is_set(),
+                        FLUSH_INTERVAL,
+                    )
+                try:
+                    self.flush(connection)
+                    if time.monotonic() - self.last_prune > PRUNE_INTERVAL:
+                        self.prune(connection)
+                except sqlite3.Error as e:
+                    logging.error("Failed writing sensor readings: %s", e)
+                    # The pending readings already fill a batch, don't retry right away
+                    self.stop_event.wait(FLUSH_INTERVAL)
+            self.flush(connection)
+        finally:
+            connection.close()
+
+    def stop(self):
+        """Write the last batch and stop, stop_event must be set already"""
+        with self.condition:
+            self.condition.notify()
+        self.join()
+
+    def pending_matching(
+        self,
+        start: float | None = None,
+        end: float | None = None,
+        session: int | None = None,
+        sensor: str | None = None,
+    ) -> list[tuple]:
+        """Readings matching the filters that haven't been written yet. Taken before
+        reading the table, a batch written meanwhile is then in both and deduplicated.
+        """
+        with self.condition:
+            pending = list(self.pending)
+        return sorted(
+            row
+            for row in pending
+            if (start is None or row[0] >= start)
+            and (end is None or row[0] <= end)
+            and (session is None or row[1] == session)
+            and (sensor is None or row[2] == sensor)
+        )
+
+    def query(
+        self,
+        start: float | None = None,
+        end: float | None = None,
+        session: int | None = None,
+        sensor: str | None = None,
+        limit: int = 1000,
+        after: tuple[float, int] | None = None,
+    ) -> tuple[list[dict], tuple[float, int] | None]:
+        """A page of the readings matching every given filter, oldest first. The last
+        page also has the readings that are still waiting for the next batch.
+        Args:
+            limit: Maximum stored readings in the page
+            after: The cursor returned with the previous page
+        Returns:
+            The readings and the cursor of the next page, None on the last one
+        """
+        conditions, params = [], []
+        for condition, param in (
+            ("timestamp >= ?", start),
+            ("timestamp <= ?", end),
+            ("session = ?", session),
+            ("sensor = ?", sensor),
+        ):
+            if param is not None:
+                conditions.append(condition)
+                params.append(param)
+        if after is not None:
+            conditions.append("(timestamp > ? OR (timestamp = ? AND rowid > ?))")
+            params.extend((after[0], after[0], after[1]))
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        pending = self.pending_matching(start, end, session, sensor)
+        connection = self.connect()
+        try:
+            rows = connection.execute(
+                f"SELECT {', '.join(COLUMNS)}, rowid FROM readings {where} "
+                "ORDER BY timestamp, rowid LIMIT ?",
+                (*params, limit),
+            ).fetchall()
+        finally:
+            connection.close()
+        readings = [dict(zip(COLUMNS, row)) for row in rows]
+        if len(rows) == limit:
+            return readings, (rows[-1][0], rows[-1][-1])
+        stored = {reading_key(row) for row in rows}
+        readings.extend(
+            dict(zip(COLUMNS, row)) for row in pending if reading_key(row) not in stored
+        )
+        return readings, None
+
+    def export_session(self, session: int):
+        """Generator of the readings of a session as CSV, a row per reading"""
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(COLUMNS)
+        pending = self.pending_matching(session=session)
+        newest = {reading_key(row) for row in pending}
+        connection = self.connect()
+        try:
+            cursor = connection.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM readings WHERE session = ? "
+                "ORDER BY timestamp",
+                (session,),
+            )
+            while rows := cursor.fetchmany(BATCH_SIZE):
+                writer.writerows(rows)
+                newest.difference_update(reading_key(row) for row in rows)
+                if buffer.tell() > EXPORT_CHUNK:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+        finally:
+            connection.close()
+        writer.writerows(row for row in pending if reading_key(row) in newest)
+        yield buffer.getvalue()
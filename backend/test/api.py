@@ -28,7 +28,7 @@ app = api.create(__name__)
 # Shared data
 stop_event = threading.Event()
 side_cam = CameraThread("RGB", CAM_RGB_INDEX, stop_event, 800, 600)
-top_cam = CameraThread("RGBT", CAM_RGBT_INDEX, stop_event, 848, 480)
+top_cam = CameraThread("RGBT", CAM_RGBT_INDEX, stop_event, 848, 480, 424, 240)
 
 
 @app.route("/dashboard/photos")
@@ -0,0 +1,230 @@
+"""Benchmark the API hot paths against synthetic session directories.
+
+Usage: python -m test.benchmark [--images 10 100 1000] [--sessions 3] [--output out.json]
+Every case runs in its own forked process so its peak RSS can be told apart. The results
+are printed and optionally stored as JSON to compare them across commits.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+os.environ["HARDWARE"] = "sim"
+os.environ.setdefault("CAM_DEST", tempfile.mkdtemp(prefix="benchmark-"))
+os.environ.setdefault("AP_SSID", "benchmark")
+os.environ.setdefault("WIFI_PORT", "0")
+
+# pylint: disable=wrong-import-position
+import cv2
+import numpy as np
+
+import api
+import config
+import utils
+from data import photos_taken, states
+from manifest import forget_manifests, get_manifest
+from modules.camera import CameraThread
+
+LABELS = ("RGB", "RGBT", "RE", "RGN")
+STEPS = 6
+IMAGE_SIZE = (640, 480)
+REQUESTS = 50
+ZIP_REQUESTS = 3
+VIDEO_CLIENTS = 3
+VIDEO_DURATION = 5.0
+PERCENTILES = (50, 90, 99)
+
+
+def create_image() -> bytes:
+    """Encode a noisy image once, it's linked under every synthetic name"""
+    width, height = IMAGE_SIZE
+    image = np.random.randint(0, 255, (height // 4, width // 4, 3), dtype=np.uint8)
+    image = cv2.resize(image, (width, height), interpolation=cv2.INTER_LINEAR)
+    return cv2.imencode(".png", image)[1].tobytes()
+
+
+def create_sessions(base: str, sessions: int, images: int) -> int:
+    """Fill the destination with sessions holding the given amount of images each
+    Returns:
+        The number of the last session
+    """
+    template = os.path.join(base, "template.png")
+    with open(template, "wb") as file:
+        file.write(create_image())
+
+    for session in range(sessions):
+        dirpath = utils.get_session_dirpath(base, session)
+        manifest = get_manifest(dirpath)
+        for i in range(images):
+            run, index = divmod(i, len(LABELS) * STEPS)
+            label, step = LABELS[index // STEPS], index % STEPS
+            filename = utils.generate_photo_name(label, 1_700_000_000 + run * 60, step)
+            os.link(template, os.path.join(dirpath, filename))
+            manifest.add(filename)
+    os.remove(template)
+    forget_manifests()
+    return sessions - 1
+
+
+def summarize(latencies: list[float], transferred: int, elapsed: float) -> dict:
+    """Latency percentiles in milliseconds and the throughput of a case"""
+    milliseconds = np.array(latencies) * 1000
+    summary = {
+        "requests": len(latencies),
+        "mean_ms": float(milliseconds.mean()),
+        "max_ms": float(milliseconds.max()),
+    }
+    for percentile in PERCENTILES:
+        summary[f"p{percentile}_ms"] = float(np.percentile(milliseconds, percentile))
+    summary["bytes"] = transferred
+    summary["bytes_per_s"] = transferred / elapsed if elapsed else 0.0
+    return summary
+
+
+def bench_requests(client, url: str, requests: int) -> dict:
+    """Request an URL repeatedly, reading the whole body every time"""
+    latencies = []
+    transferred = 0
+    started = time.perf_counter()
+    for _ in range(requests):
+        request_started = time.perf_counter()
+        response = client.get(url, buffered=False)
+        for chunk in response.response:
+            transferred += len(chunk)
+        response.close()
+        latencies.append(time.perf_counter() - request_started)
+    return summarize(latencies, transferred, time.perf_counter() - started)
+
+
+def bench_video(client, clients: int, duration: float) -> dict:
+    """Several clients watching the same camera, measuring the time between frames"""
+    camera = CameraThread("RGB", 0, threading.Event(), 800, 600)
+    camera.start()
+    gaps: list[list[float]] = [[] for _ in range(clients)]
+    received = [0] * clients
+
+    def watch(index: int):
+        response = client.get("/video/0", buffered=False)
+        last = time.perf_counter()
+        for chunk in response.response:
+            now = time.perf_counter()
+            gaps[index].append(now - last)
+            received[index] += len(chunk)
+            last = now
+            if now - started > duration:
+                break
+        response.close()
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=watch, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    camera.stop_event.set()
+    camera.join()
+
+    summary = summarize(sum(gaps, []), sum(received), elapsed)
+    summary["clients"] = clients
+    summary["fps_per_client"] = summary["requests"] / clients / elapsed
+    summary["encoded"] = camera.broadcaster.encoded
+    summary["passthrough"] = camera.broadcaster.passthrough
+    return summary
+
+
+def run_case(case: str, images: int, sessions: int, queue):
+    """Body of the forked process of a single case"""
+    if case != "video":
+        config.CAM_DEST = tempfile.mkdtemp(
+            prefix=f"{case}-{images}-", dir=config.CAM_DEST
+        )
+        session = create_sessions(config.CAM_DEST, sessions, images)
+        states.set(states.SESSION, session)
+        states.set(states.TRANSFERRED, True)
+        for key in (
+            photos_taken.SIDE,
+            photos_taken.TOP,
+            photos_taken.IR,
+            photos_taken.UV,
+        ):
+            photos_taken.set(key, STEPS)
+
+    client = api.create(__name__).test_client()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if case == "dashboard":
+        result = bench_requests(client, "/dashboard", REQUESTS)
+    elif case == "photos":
+        result = bench_requests(client, "/photos", REQUESTS)
+    elif case == "session":
+        result = bench_requests(client, "/session", ZIP_REQUESTS)
+    else:
+        result = bench_video(client, VIDEO_CLIENTS, VIDEO_DURATION)
+
+    # ru_maxrss is in KiB on Linux
+    result["peak_rss_kib"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result["setup_rss_kib"] = rss_before
+    if case != "video":
+        shutil.rmtree(config.CAM_DEST)
+    queue.put(result)
+
+
+def run_forked(case: str, images: int, sessions: int) -> dict:
+    context = multiprocessing.get_context("fork")
+    queue = context.Queue()
+    process = context.Process(target=run_case, args=(case, images, sessions, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def describe() -> dict:
+    """Identify the code and the machine the results belong to"""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "opencv": cv2.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--images", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--sessions", type=int, default=3)
+    parser.add_argument(
+        "--cases", nargs="+", default=["dashboard", "photos", "session", "video"]
+    )
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = {**describe(), "sessions": args.sessions, "cases": {}}
+    for case in args.cases:
+        for images in args.images if case in ("photos", "session") else [0]:
+            name = f"{case}-{images}" if images else case
+            results["cases"][name] = run_forked(case, images, args.sessions)
+            print(name, json.dumps(results["cases"][name]), flush=True)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
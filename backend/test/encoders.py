@@ -0,0 +1,140 @@
+"""Compare the still encoders on real frames, encode time against file size.
+
+Usage: python -m test.encoders [--frames session_dir photo.png ...] [--output out.json]
+The frames are read from the given images or session directories, or grabbed from the
+side camera at its still resolution otherwise (HARDWARE=sim for the simulated one). Every
+encoder is timed on a single core and spread over the encoder processes of the writer.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import time
+
+import cv2
+import numpy as np
+
+from modules.writer import ENCODER_PROCESSES, create_pool, encode, jpeg, png, tiff
+from modules.writer import webp_lossless
+
+IMAGE_FORMATS = (".png", ".jpg", ".jpeg", ".webp", ".tif", ".tiff")
+STILL_SIZE = (800, 600)
+CAMERA_FRAMES = 5
+REPEAT = 3
+ENCODERS = {
+    "png-0": png(0),
+    "png-1": png(1),
+    "png-3": png(3),
+    "png-6": png(6),
+    "png-9": png(9),
+    "webp-lossless": webp_lossless(),
+    "tiff-lzw": tiff(),
+    "tiff-none": tiff(1),
+    "jpeg-95": jpeg(95),
+    "jpeg-90": jpeg(90),
+}
+
+
+def load_frames(paths: list[str]) -> list[np.ndarray]:
+    """Read every image given, directories are searched for images"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(
+                os.path.join(path, name)
+                for name in sorted(os.listdir(path))
+                if name.lower().endswith(IMAGE_FORMATS)
+            )
+        else:
+            files.append(path)
+    frames = [cv2.imread(file, cv2.IMREAD_COLOR) for file in files]
+    return [frame for frame in frames if frame is not None]
+
+
+def grab_frames(count: int) -> list[np.ndarray]:
+    """Take consecutive frames from the side camera at the still resolution"""
+    from hardware import VideoCapture  # pylint: disable=import-outside-toplevel
+
+    capture = VideoCapture(0)
+    capture.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*"MJPG"))
+    capture.set(cv2.CAP_PROP_FRAME_WIDTH, STILL_SIZE[0])
+    capture.set(cv2.CAP_PROP_FRAME_HEIGHT, STILL_SIZE[1])
+    frames = []
+    try:
+        while len(frames) < count:
+            status, frame = capture.read()
+            if status and frame is not None and frame.size > 0:
+                frames.append(frame)
+    finally:
+        capture.release()
+    return frames
+
+
+def bench_encoder(encoder, frames: list[np.ndarray], pool, repeat: int) -> dict:
+    """Time an encoder on every frame, alone and spread over the pool"""
+    times, sizes = [], []
+    for frame in frames:
+        elapsed = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            encoded = encoder.encode(frame)
+            elapsed.append(time.perf_counter() - started)
+        times.append(statistics.median(elapsed))
+        sizes.append(len(encoded))
+
+    jobs = [frame for frame in frames for _ in range(repeat)]
+    started = time.perf_counter()
+    list(pool.map(encode, [encoder] * len(jobs), jobs))
+    parallel = time.perf_counter() - started
+
+    raw = sum(frame.nbytes for frame in frames)
+    return {
+        "encode_ms": round(statistics.mean(times) * 1000, 1),
+        "size_kb": round(statistics.mean(sizes) / 1024, 1),
+        "ratio": round(sum(sizes) / raw, 3),
+        "frames_per_s": round(len(frames) / sum(times), 1),
+        "pool_frames_per_s": round(len(jobs) / parallel, 1),
+    }
+
+
+def describe(frames: list[np.ndarray]) -> dict:
+    """Identify the code, the machine and the frames the results belong to"""
+    # Importing the API benchmark switches to the simulated hardware, so only after the
+    # frames were grabbed
+    from test import benchmark  # pylint: disable=import-outside-toplevel
+
+    return {
+        **benchmark.describe(),
+        "processes": ENCODER_PROCESSES,
+        "frames": len(frames),
+        "frame_size": list(frames[0].shape[1::-1]),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--frames", nargs="+", help="Images or session directories")
+    parser.add_argument("--encoders", nargs="+", default=list(ENCODERS))
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    frames = load_frames(args.frames) if args.frames else grab_frames(CAMERA_FRAMES)
+    if not frames:
+        parser.error("No frames to encode")
+
+    results = {**describe(frames), "encoders": {}}
+    pool = create_pool()
+    try:
+        for name in args.encoders:
+            results["encoders"][name] = bench_encoder(
+                ENCODERS[name], frames, pool, args.repeat
+            )
+            print(name, json.dumps(results["encoders"][name]), flush=True)
+    finally:
+        pool.shutdown()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
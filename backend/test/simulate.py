@@ -0,0 +1,106 @@
+"""Run a whole acquisition session against the simulated hardware and time it.
+
+Usage: python -m test.simulate [--api] [--output results.json]
+Prints the duration of every scheduler task and the end-to-end time of the session.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+os.environ["HARDWARE"] = "sim"
+os.environ.setdefault("CAM_DEST", tempfile.mkdtemp(prefix="fenotipado-"))
+os.environ.setdefault(
+    "SENSOR_DB", os.path.join(tempfile.mkdtemp(prefix="sensors-"), "sensors.db")
+)
+os.environ.setdefault("AP_SSID", "simulated")
+os.environ.setdefault("WIFI_PORT", "0")
+
+import main  # pylint: disable=wrong-import-position
+import utils  # pylint: disable=wrong-import-position
+from data import data, states  # pylint: disable=wrong-import-position
+from modules.camera import CameraThread  # pylint: disable=wrong-import-position
+from modules.sensors import SensorPoller  # pylint: disable=wrong-import-position
+
+SESSION_TIMEOUT = 600
+
+
+def run_session() -> float:
+    """Run the main loop from start until the transfer finished
+    Returns:
+        The seconds it took
+    """
+    states.set(states.SESSION, utils.get_next_numeric_subdir(main.CAM_DEST))
+    states.set(states.TRANSFERRED, False)
+    data.set(data.PROGRESS, 0)
+    data.set(data.RUNNING, True)
+
+    started = time.monotonic()
+    while not states.get(states.TRANSFERRED) or main.scheduler.busy():
+        if time.monotonic() - started > SESSION_TIMEOUT:
+            raise TimeoutError("The simulated session didn't finish")
+        time.sleep(main.main())
+    return time.monotonic() - started
+
+
+def count_readings(session: int) -> int:
+    """Stored sensor readings of the session, counted page by page"""
+    count, cursor = 0, None
+    while True:
+        readings, cursor = SensorPoller.store.query(session=session, after=cursor)
+        count += len(readings)
+        if cursor is None:
+            return count
+
+
+def summarize(elapsed: float) -> dict:
+    session = states.get(states.SESSION)
+    dirpath = utils.get_session_dirpath(main.CAM_DEST, session, create=False)
+    tasks = {
+        name: {
+            "count": len(durations),
+            "mean": statistics.mean(durations),
+            "max": max(durations),
+        }
+        for name, durations in main.scheduler.durations.items()
+    }
+    return {
+        "session": session,
+        "elapsed": elapsed,
+        "files": len(os.listdir(dirpath)),
+        "tasks": tasks,
+        "writer_failed": CameraThread.writer.failed,
+        "sensor_readings": count_readings(session),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--api", action="store_true", help="Serve the API meanwhile")
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    if args.api:
+        threading.Thread(target=main.start_api, daemon=True).start()
+    SensorPoller.store.start()
+    for poller in main.create_sensor_pollers():
+        poller.start()
+    threading.Thread(target=main.update_display, daemon=True).start()
+    main.CameraThread.writer.start()
+    main.side_cam.start()
+    main.top_cam.start()
+    try:
+        results = summarize(run_session())
+    finally:
+        main.stop_event.set()
+        main.side_cam.release()
+        main.top_cam.release()
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
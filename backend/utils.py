@@ -3,26 +3,29 @@
 import logging
 import os
 import shutil
+import threading
 import time
-import zipfile
-from io import BytesIO
+import zlib
+from typing import Callable
 
-import digitalio
+import metrics
+from hardware import digitalio
 
-import config
+COPY_CHUNK = 1024 * 1024
 
 
-def generate_photo_name(prefix: str, timestamp: float, step: int) -> str:
+def generate_photo_name(prefix: str, timestamp: float, step: int, ext="png") -> str:
     """Return a string representation of the photo data with camera label, time and step
     Args:
         prefix: The label to identify the camera type
         timestamp: The unix time in which the process of the photo started
         step: The index of the angle in which the photo was taken
+        ext: The extension of the image format
     Returns:
-        All the data stored in a string filename (PNG) "RGB-20251119_013323-4.png"
+        All the data stored in a string filename "RGB-20251119_013323-4.png"
     """
     time_str = time.strftime("%Y%m%d_%H%M%S", time.localtime(timestamp))
-    return f"{prefix}-{time_str}-{step}.png"
+    return f"{prefix}-{time_str}-{step}.{ext}"
 
 
 def extract_photo_name(name: str):
@@ -95,54 +98,157 @@ def get_next_numeric_subdir(base_dir: str) -> int:
     return max_num + 1
 
 
-def get_session_dirpath(base: str, session: int) -> str:
+def list_sessions(base_dir: str) -> list[int]:
+    """The numbers of every session directory, in ascending order"""
+    return sorted(
+        int(name)
+        for name in os.listdir(base_dir)
+        if name.isdigit() and os.path.isdir(os.path.join(base_dir, name))
+    )
+
+
+def get_session_dirpath(base: str, session: int, create: bool = True) -> str:
     """Builds the full path of the session directory based on the number. Creates it if needed
     Args:
         base: The base directory where all the numeric directories are
         session: The number of the session you're looking for
+        create: Whether to create the directory if it doesn't exist
     Returns:
         str: The full path of the session
     """
     dirpath = os.path.join(base, str(session).zfill(8))
-    os.makedirs(dirpath, exist_ok=True)
+    if create:
+        os.makedirs(dirpath, exist_ok=True)
     return dirpath
 
 
-def zip_dir(dirpath: str) -> bytes:
-    mem = BytesIO()
+class TransferProgress:
+    """Thread safe counter of the bytes moved by concurrent transfers"""
 
-    with zipfile.ZipFile(mem, mode="w", compression=zipfile.ZIP_DEFLATED) as zip:
-        for root, _, files in os.walk(dirpath):
-            for file in files:
-                filepath = os.path.join(root, file)
-                relative = os.path.relpath(filepath, dirpath)
-                zip.write(filepath, relative)
+    def __init__(self, total: int = 0):
+        self.lock = threading.Lock()
+        self.total = total
+        self.done = 0
 
-    mem.seek(0)
-    return mem.getvalue()
+    def add(self, amount: int):
+        with self.lock:
+            self.done += amount
 
+    def fraction(self) -> float:
+        with self.lock:
+            if self.total <= 0:
+                return 1.0
+            return min(self.done / self.total, 1.0)
 
-def safe_copy(src: str, dest: str, chunk: int = 64 * 1024) -> bool:
-    # Retry 3 times
+
+def copy_file(
+    src: str,
+    dest: str,
+    chunk: int = COPY_CHUNK,
+    on_progress: Callable[[int], None] | None = None,
+) -> int:
+    """Copy a file in the kernel with copy_file_range, falling back to sendfile and then
+    to a userspace read/write loop if the filesystems don't support it.
+    Args:
+        src: The file to copy
+        dest: The destination path, overwritten if it exists
+        chunk: The amount of bytes to copy on each call
+        on_progress: Called with the amount of bytes copied after every chunk
+    Returns:
+        The amount of bytes copied
+    """
+    copied = 0
+    with open(src, "rb") as file_src, open(dest, "wb") as file_dest:
+        size = os.fstat(file_src.fileno()).st_size
+        for method in ("copy_file_range", "sendfile", None):
+            try:
+                while copied < size:
+                    if method == "copy_file_range":
+                        sent = os.copy_file_range(
+                            file_src.fileno(), file_dest.fileno(), chunk
+                        )
+                    elif method == "sendfile":
+                        sent = os.sendfile(
+                            file_dest.fileno(), file_src.fileno(), copied, chunk
+                        )
+                    else:
+                        buffer = file_src.read(chunk)
+                        sent = file_dest.write(buffer)
+                    if sent == 0:
+                        break
+                    copied += sent
+                    if on_progress is not None:
+                        on_progress(sent)
+                break
+            except (OSError, AttributeError) as e:
+                if copied > 0 or method is None:
+                    raise
+                logging.debug("Copying %s with %s failed: %s", src, method, e)
+                # Rewind in case the method moved the offsets before failing
+                file_src.seek(0)
+                file_dest.seek(0)
+    return copied
+
+
+def file_checksum(path: str, chunk: int = COPY_CHUNK) -> int:
+    """Compute the CRC32 of a file
+    Args:
+        path: The file to read
+        chunk: The amount of bytes read at a time
+    """
+    crc = 0
+    with open(path, "rb") as file:
+        while buffer := file.read(chunk):
+            crc = zlib.crc32(buffer, crc)
+    return crc
+
+
+def remove_quietly(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+@metrics.timed("safe_copy")
+def safe_copy(
+    src: str,
+    dest: str,
+    chunk: int = COPY_CHUNK,
+    on_progress: Callable[[int], None] | None = None,
+) -> int | None:
+    """Copy a file and verify the destination against the source checksum, retrying 3 times
+    Args:
+        src: The file to copy
+        dest: The destination path
+        chunk: The amount of bytes to copy at a time
+        on_progress: Called with the amount of bytes copied after every chunk
+    Returns:
+        The CRC32 of the copy once verified, only then the source can be deleted. None if
+        every attempt failed
+    """
     for _ in range(3):
-        try:
-            shutil.copy2(src, dest)
-            return True
-        except (OSError, IOError) as e:
-            logging.warning("Failed copying %s: %s", src, str(e))
-            os.remove(dest)
+        copied = 0
+
+        def count(amount: int):
+            nonlocal copied
+            copied += amount
+            if on_progress is not None:
+                on_progress(amount)
 
         try:
-            with open(src, "rb") as file_src, open(dest, "wb") as file_dest:
-                while True:
-                    buffer = file_src.read(chunk)
-                    if not buffer:
-                        break
-                    file_dest.write(buffer)
-            return True
+            copy_file(src, dest, chunk, count)
+            shutil.copystat(src, dest)
+            crc = file_checksum(dest, chunk)
+            if file_checksum(src, chunk) == crc:
+                return crc
+            logging.error("Checksum mismatch copying %s, retrying.", src)
         except (OSError, IOError) as e:
-            logging.error("Failed manually copying %s: %s", src, str(e))
-            os.remove(dest)
+            logging.error("Failed copying %s: %s", src, str(e))
 
+        # Don't count the failed attempt twice
+        if on_progress is not None and copied:
+            on_progress(-copied)
+        remove_quietly(dest)
         time.sleep(0.5)
-    return False
+    return None
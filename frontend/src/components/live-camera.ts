@@ -1,24 +1,45 @@
 import "./live-camera.css";
 import "./widget.css";
 
+// Milliseconds before reconnecting a failed stream, doubled on every failure in a row
+const RETRY_MIN = 1000;
+const RETRY_MAX = 30000;
+
 class LiveCamera extends HTMLElement {
   private img: HTMLImageElement | undefined;
+  private retry = RETRY_MIN;
 
   constructor() {
     super();
     this.render();
   }
 
+  // Ask for frames no wider than the widget so the server downscales them once for
+  // every viewer of that size
+  streamUrl = (src: string) => {
+    const params = new URLSearchParams({ t: String(Date.now()) });
+    const width = Math.round(this.clientWidth * window.devicePixelRatio);
+    if (width > 0) params.set("width", String(width));
+    return `${src}?${params}`;
+  };
+
   render = () => {
     const src = this.getAttribute("src") || "";
     this.innerHTML = "";
 
     this.img = document.createElement("img");
-    this.img.src = `${src}?t=${Date.now()}`;
+    this.img.src = this.streamUrl(src);
 
-    setInterval(() => {
-      this.img!.src = `${src}?t=${Date.now()}`;
-    }, 2000);
+    // Keep a single stream open, the server adapts its rate to this connection
+    this.img.addEventListener("load", () => {
+      this.retry = RETRY_MIN;
+    });
+    this.img.addEventListener("error", () => {
+      setTimeout(() => {
+        this.img!.src = this.streamUrl(src);
+      }, this.retry);
+      this.retry = Math.min(this.retry * 2, RETRY_MAX);
+    });
 
     this.appendChild(this.img);
   };
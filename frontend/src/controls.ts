@@ -12,23 +12,19 @@ function toggleDisabled(button: HTMLButtonElement, disabled: boolean) {
   button.classList.toggle("disabled", disabled);
 }
 
-buttons.download.addEventListener("click", async () => {
+buttons.download.addEventListener("click", () => {
   toggleDisabled(buttons.download, true);
 
   try {
+    // Let the browser stream the archive straight to disk instead of buffering a blob
     dispatchToast("Preparing files for download...");
-    const res = await fetch("/api/session/download");
-    if (!res.ok) return dispatchToast("Error while downloading.");
-
-    const blob = await res.blob();
-    const url = URL.createObjectURL(blob);
     const a = document.createElement("a");
-    a.href = url;
+    a.href = "/api/session";
+    a.download = "all_sessions.zip";
 
     document.body.appendChild(a);
     a.click();
     a.remove();
-    URL.revokeObjectURL(url);
   } finally {
     toggleDisabled(buttons.download, false);
   }
@@ -38,7 +34,7 @@ buttons.delete.addEventListener("click", async () => {
   toggleDisabled(buttons.delete, true);
 
   try {
-    const res = await fetch("/api/session/delete", { method: "DELETE" });
+    const res = await fetch("/api/session", { method: "DELETE" });
     if (!res.ok) return dispatchToast("Failed to delete stored files. Try again");
 
     const data = await res.json();
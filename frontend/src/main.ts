@@ -15,28 +15,16 @@ import "./components/widget-button";
 import "./controls";
 import "./results";
 
-const FETCH_INTERVAL = 2000;
-setInterval(async () => {
-  const res = await fetch("/api/dashboard");
-  // const res = {
-  //   ok: true,
-  //   json: () => ({
-  //     temp: Math.random() * 50,
-  //     "white-light": Math.random() * 1000,
-  //     "ir-light": Math.random() * 1000,
-  //     "uv-light": Math.random() * 14,
-  //     hum: Math.random() * 100,
-  //     angle: Math.random() * 300,
-  //     progress: Math.random() * 100,
-  //     running: Math.random() > 0.5 ? 1 : 0,
-  //   }),
-  // };
-  if (!res.ok) {
-    console.error("Error fetching dashboard data.", res);
-    return;
-  }
+// The backend pushes the changed dashboard keys and the session events as they happen
+const SERVER_EVENTS = {
+  session_started: "sessionStarted",
+  photo_saved: "photoSaved",
+  transfer_completed: "transferCompleted",
+};
 
-  const data = await res.json();
+const events = new EventSource("/api/events");
+events.addEventListener("dashboard", (ev) => {
+  const data = JSON.parse((ev as MessageEvent).data);
   Object.entries(data).forEach(([key, value]) => {
     const widget = document.getElementById(key);
     if (!widget) {
@@ -46,7 +34,17 @@ setInterval(async () => {
 
     widget.setAttribute("value", String(value));
   });
-}, FETCH_INTERVAL);
+});
+Object.entries(SERVER_EVENTS).forEach(([name, documentEvent]) => {
+  events.addEventListener(name, (ev) => {
+    const detail = JSON.parse((ev as MessageEvent).data);
+    document.dispatchEvent(new CustomEvent(documentEvent, { detail }));
+  });
+});
+events.addEventListener("error", () => {
+  // EventSource reconnects by itself and the server resends the whole dashboard
+  console.error("Lost connection with the server, reconnecting...");
+});
 
 function getPercentage(value: number, min: number, max: number) {
   return (value - min) / (max - min);
@@ -56,21 +54,18 @@ function applyPercentage(percentage: number, min: number, max: number) {
   return min + (max - min) * percentage;
 }
 
-async function poll(src: string, maxAttempts = 10) {
-  for (let i = 0; i < maxAttempts; i++) {
-    try {
-      const res = await fetch(src, { headers: { "Content-Type": "application/json" } });
-      if (res.status !== 200) continue;
-
-      return await res.json();
-    } catch (err) {
-      console.error("Error polling", err);
-    } finally {
-      await new Promise((resolve) => setTimeout(resolve, 2000));
-    }
-  }
-
-  return null;
+function waitForEvent<T>(name: string, timeout: number): Promise<T | null> {
+  return new Promise((resolve) => {
+    const timer = setTimeout(() => {
+      document.removeEventListener(name, listener);
+      resolve(null);
+    }, timeout);
+    const listener = (ev: Event) => {
+      clearTimeout(timer);
+      resolve((ev as CustomEvent<T>).detail);
+    };
+    document.addEventListener(name, listener, { once: true });
+  });
 }
 
-export { applyPercentage, getPercentage, poll };
+export { applyPercentage, getPercentage, waitForEvent };
@@ -1,4 +1,4 @@
-import { poll } from "./main";
+import { waitForEvent } from "./main";
 import { dispatchToast } from "./toast";
 import "./results.css";
 
@@ -9,7 +9,10 @@ const content = resultPopup.querySelector(".popup-main") as HTMLDivElement;
 const currentPages = document.getElementById("current-page") as HTMLSpanElement;
 const totalPages = document.getElementById("total-pages") as HTMLSpanElement;
 
-type Response = { filename: string; content: string; content_type: string };
+// Longest a transfer of the Survey3 pictures may take before giving up on the results
+const TRANSFER_TIMEOUT = 5 * 60 * 1000;
+
+type Response = { filename: string; url: string; size: number; content_type: string };
 type Data = {
   completed: boolean;
   photo_counts: { RGB: number; RGBT: number; RE: number; RGN: number };
@@ -34,6 +37,10 @@ class Result {
     this.title.textContent = this.images[Result.index]?.title || "...";
     this.image.src = this.images[Result.index]?.image || "";
     this.counter.textContent = String(this.images.length);
+
+    // Warm the browser cache with the next page while this one is being looked at
+    const next = this.images[(Result.index + 1) % (Result.max || 1)];
+    if (next) new Image().src = next.image;
   }
 
   reset() {
@@ -44,11 +51,29 @@ class Result {
   static mapResults(response: Response) {
     return {
       title: response ? response.filename : "",
-      image: response ? `data:${response.content_type};base64,${response.content}` : "",
+      image: response ? `/api${response.url}` : "",
     };
   }
 }
 
+async function fetchResults(): Promise<Data | null> {
+  type Transfer = { session: number; verified: boolean };
+  const transfer = await waitForEvent<Transfer>("transferCompleted", TRANSFER_TIMEOUT);
+  if (!transfer) {
+    console.error("Timed out waiting for the image transfer.");
+    return null;
+  }
+  if (!transfer.verified) dispatchToast("Some images couldn't be transferred.");
+
+  try {
+    const res = await fetch("/api/photos");
+    if (res.ok) return await res.json();
+  } catch (err) {
+    console.error("Error fetching photos", err);
+  }
+  return null;
+}
+
 let transferring = false;
 const results = {
   side: new Result("rgb"),
@@ -66,7 +91,7 @@ document.addEventListener("runningFinished", async () => {
   content.style.display = "none";
   loader.style.display = "flex";
 
-  const data: Data | null = await poll("/api/photos");
+  const data = await fetchResults();
   try {
     if (!data) return dispatchToast("Failed to fetch images.");
   } finally {